@@ -9,7 +9,7 @@ from django.contrib.contenttypes.generic import GenericTabularInline
 from django.db.models import Count
 
 
-from binalerts.models import BinCollection, BinCollectionType, Street, CollectionAlert, DataImport
+from binalerts.models import BinCollection, BinCollectionType, Street, CollectionAlert, AlertShardLease, AlertMessage, DataImport, ImportSource, ImportJob, ImportRun, ImportEvent
 from emailconfirmation.models import EmailConfirmation
 
 class BinCollectionAdmin(admin.ModelAdmin):
@@ -39,7 +39,7 @@ class StreetAdmin(admin.ModelAdmin):
 
         
 class DataImportAdmin(admin.ModelAdmin):
-    actions = ('execute_import_data',)
+    actions = ('execute_import_data', 'preview_import_data')
     list_display = ('upload_file', 'timestamp', 'implicit_collection_type', 'guess_postcodes')
 
     # for historic (Barnet) reasons, hardwire implicit collection types for now: use can always override
@@ -58,14 +58,23 @@ class DataImportAdmin(admin.ModelAdmin):
                 self.message_user(request, "*%s file automatically assumed to be for %s" % (obj.upload_file.name[-4:], obj.implicit_collection_type))
         obj.save()
          
+    # the imports are run in the background by the runimportjobs command (see ImportJob)
     def execute_import_data(self, request, queryset):
+        n_jobs = 0
         for di in queryset:
-            report_lines = di.import_data() 
-            self.message_user(request, "Imported data")
-            for rl in report_lines:
-                self.message_user(request, rl)
+            ImportJob.objects.enqueue(di)
+            n_jobs += 1
+        self.message_user(request, "Queued %d import(s): see Import jobs for their progress and reports" % n_jobs)
     execute_import_data.short_description = "Import data from file"
 
+    def preview_import_data(self, request, queryset):
+        n_jobs = 0
+        for di in queryset:
+            ImportJob.objects.enqueue(di, dry_run=True)
+            n_jobs += 1
+        self.message_user(request, "Queued %d dry run(s): see Import jobs for the change plans, which can be applied from there" % n_jobs)
+    preview_import_data.short_description = "Preview import from file (dry run)"
+
 class EmailConfirmationInline(GenericTabularInline):
     model = EmailConfirmation
     extra = 1
@@ -75,16 +84,116 @@ class EmailConfirmationInline(GenericTabularInline):
 
 class CollectionAlertAdmin(admin.ModelAdmin):
     inlines = (EmailConfirmationInline,)
-    list_display = ('email', 'street', 'is_confirmed')
+    list_display = ('email', 'street', 'alert_slot', 'is_confirmed')
     search_fields = ('email', 'street__name')
     readonly_fields = ('last_checked_date', 'last_sent_date')
 
+class AlertShardLeaseAdmin(admin.ModelAdmin):
+    list_display = ('run_date', 'slot', 'shard', 'street_id_from', 'street_id_to', 'holder', 'expires', 'completed', 'last_alert_id', 'n_sent', 'n_failed')
+    list_filter = ('run_date', 'slot', 'completed')
+
+class AlertMessageAdmin(admin.ModelAdmin):
+    list_display = ('email', 'send_date', 'subject', 'sent', 'attempts', 'last_error')
+    list_filter = ('send_date',)
+    search_fields = ('email',)
+    readonly_fields = ('created', 'sent', 'attempts', 'last_error', 'holder', 'expires')
+
+# deleting a source makes the next import of that file a full one
+class ImportSourceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_imported', 'row_count')
+    readonly_fields = ('file_digest', 'last_imported')
+
+    def queryset(self, request):
+        return ImportSource.objects.annotate(row_count=Count('row_digests'))
+
+    def row_count(self, inst):
+        return inst.row_count
+    row_count.admin_order_field = 'row_count'
+
+# links to the events of an import run
+def run_events_link(run_id):
+    if run_id is None:
+        return ''
+    return '<a href="/admin/binalerts/importevent/?run__id__exact=%d">report</a>' % run_id
+
+class ImportJobAdmin(admin.ModelAdmin):
+    actions = ('requeue', 'apply')
+    list_display = ('description', 'dry_run', 'status', 'n_rows', 'n_new_streets', 'n_errors', 'created', 'started', 'finished', 'events_link')
+    list_filter = ('status',)
+    readonly_fields = ('data_import', 'description', 'dry_run', 'status', 'holder', 'created', 'started', 'finished', 'n_rows', 'n_new_streets', 'n_errors', 'import_run', 'report')
+    change_list_template = 'admin/binalerts/importjob/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
+
+    # the list reloads itself while there are imports waiting or running
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['refresh'] = ImportJob.objects.filter(status__in=('queued', 'running')).count() > 0
+        return super(ImportJobAdmin, self).changelist_view(request, extra_context)
+
+    # for jobs which failed, or whose worker died: only possible while the file's still there
+    def requeue(self, request, queryset):
+        n_jobs = queryset.filter(data_import__isnull=False).exclude(status='done').update(status='queued', holder='', started=None, finished=None)
+        self.message_user(request, "Queued %d import(s) again" % n_jobs)
+    requeue.short_description = "Queue again"
+
+    # imports the files of finished dry runs for real (the plan is worked out again, against the data as it is then)
+    def apply(self, request, queryset):
+        n_jobs = 0
+        for job in queryset.filter(dry_run=True, status='done', data_import__isnull=False):
+            ImportJob.objects.enqueue(job.data_import)
+            n_jobs += 1
+        self.message_user(request, "Queued %d import(s) of previewed files" % n_jobs)
+    apply.short_description = "Apply dry run (import for real)"
+
+    def events_link(self, inst):
+        return run_events_link(inst.import_run_id)
+    events_link.allow_tags = True
+    events_link.short_description = 'report'
+
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ('description', 'started', 'finished', 'n_rows', 'n_skipped', 'n_collections', 'n_new_streets', 'n_warnings', 'n_errors', 'events_link')
+    readonly_fields = ('description', 'started', 'finished', 'n_rows', 'n_skipped', 'n_collections', 'n_new_streets', 'n_warnings', 'n_errors')
+
+    def has_add_permission(self, request):
+        return False
+
+    def events_link(self, inst):
+        return run_events_link(inst.id)
+    events_link.allow_tags = True
+    events_link.short_description = 'report'
+
+# a run can have an event for every line of a big file, so these are paged and filtered
+class ImportEventAdmin(admin.ModelAdmin):
+    list_display = ('line', 'severity', 'message', 'street_link', 'run')
+    list_filter = ('severity', 'run')
+    search_fields = ('message',)
+    list_per_page = 200
+    readonly_fields = ('run', 'seq', 'line', 'severity', 'message', 'street_id')
+
+    def has_add_permission(self, request):
+        return False
+
+    def street_link(self, inst):
+        if inst.street_id is None:
+            return ''
+        return '<a href="/admin/binalerts/street/%d/">%d</a>' % (inst.street_id, inst.street_id)
+    street_link.allow_tags = True
+    street_link.short_description = 'street'
+
 class CollectionTypeAdmin(admin.ModelAdmin):
     list_display = ('description', 'friendly_id', 'detail_text')
 
 admin.site.register(CollectionAlert, CollectionAlertAdmin)
+admin.site.register(AlertShardLease, AlertShardLeaseAdmin)
+admin.site.register(AlertMessage, AlertMessageAdmin)
 admin.site.register(BinCollection, BinCollectionAdmin)
 admin.site.register(BinCollectionType, CollectionTypeAdmin)
 admin.site.register(Street, StreetAdmin)
 admin.site.register(DataImport, DataImportAdmin)
+admin.site.register(ImportSource, ImportSourceAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(ImportRun, ImportRunAdmin)
+admin.site.register(ImportEvent, ImportEventAdmin)
 
@@ -0,0 +1,291 @@
+# alerts.py:
+# Rendering and sending of alert emails for Bin Alerts.
+#
+# Copyright (c) 2011 UK Citizens Online Democracy. All rights reserved.
+# Email: francis@mysociety.org; WWW: http://www.mysociety.org/
+
+import smtplib
+import socket
+import threading
+import time
+import Queue
+
+import settings # from which we get
+                 # BINS_ALERT_BATCH_SIZE
+                 # BINS_ALERT_SEND_RETRIES
+                 # DEFAULT_FROM_EMAIL
+
+from django.core.mail import get_connection, EmailMessage
+from django.template import Context
+from django.template.loader import get_template
+
+# Everyone on a street gets the same alert on a given day, apart from the
+# unsubscribe link at the bottom. So the subject and the main body
+# (email-alert.txt) are rendered once per street and day, and only the
+# unsubscribe footer (email-alert-unsubscribe.txt) is rendered per subscriber.
+# Use one cache per alert run; it can be shared between sending threads.
+class AlertRenderCache(object):
+    def __init__(self, domain):
+        self.domain = domain
+        self.body_template = get_template('email-alert.txt')
+        self.unsubscribe_template = get_template('email-alert-unsubscribe.txt')
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    # returns (subject, body without the unsubscribe footer) for the collections on a street
+    def get_subject_and_body(self, street, day_name, collections):
+        key = (street.id, day_name)
+        self.lock.acquire()
+        try:
+            if key not in self.rendered:
+                self.rendered[key] = self._render_subject_and_body(street, day_name, collections)
+            return self.rendered[key]
+        finally:
+            self.lock.release()
+
+    def _render_subject_and_body(self, street, day_name, collections):
+        bin_collection_types_subject = " + ".join(bc.get_collection_type_display() for bc in collections)
+        bin_collection_types_list = "\n".join("  * %s\n" % bc.get_collection_type_display() for bc in collections)
+        subject = 'Bin collection tomorrow, %s! (%s)' % (day_name, bin_collection_types_subject)
+        body = self.body_template.render(Context({
+            'bin_collection_types_list': bin_collection_types_list,
+            'street_name': street.__unicode__(),
+            'tomorrow_day_name': day_name,
+            'domain': self.domain,
+        }))
+        return (subject, body)
+
+    # returns (subject, body) of the alert email for one subscriber
+    def render(self, street, day_name, collections, collection_alert):
+        subject, body = self.get_subject_and_body(street, day_name, collections)
+        footer = self.unsubscribe_template.render(Context({
+            'domain': self.domain,
+            'unsubscribe_url': collection_alert.get_unsubscribe_url(),
+        }))
+        return subject, body + footer
+
+    # returns the alert email for one subscriber, ready to send
+    def render_message(self, street, day_name, collections, collection_alert):
+        subject, body = self.render(street, day_name, collections, collection_alert)
+        return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [collection_alert.email])
+
+# whether an error returned by AlertMailer.send means the message will never get
+# through (the server refused the recipient), so there's no point trying again
+def is_permanent_failure(error):
+    return error is not None and error.startswith('SMTPRecipientsRefused:')
+
+# Sends alert emails over one mail connection for the whole run, rather than
+# a new connection per email. The connection is reopened after every
+# batch_size messages (mail servers often limit messages per connection), and
+# results are handed back a batch at a time so the caller can do its
+# bookkeeping batch by batch. If sending fails the connection is reopened and
+# the message retried, up to BINS_ALERT_SEND_RETRIES times. Recipients the
+# server refuses are not retried.
+# The connection comes from Django's email settings (EMAIL_HOST, EMAIL_PORT),
+# so a run can be pointed at a local SMTP stand-in, e.g.
+#     python -m smtpd -n -c DebuggingServer localhost:1025
+class AlertMailer(object):
+    def __init__(self, batch_size=None, retries=None, backend=None, timer=None):
+        self.batch_size = batch_size or settings.BINS_ALERT_BATCH_SIZE
+        if retries is None:
+            retries = settings.BINS_ALERT_SEND_RETRIES
+        self.retries = retries
+        self.backend = backend
+        self.timer = timer # an AlertRunTimer, if timing the run
+        self.connection = None
+        self.n_sent_on_connection = 0
+        self.n_sent = 0
+        self.n_failed = 0
+
+    def open(self):
+        if self.connection is not None and self.n_sent_on_connection >= self.batch_size:
+            self.close()
+        if self.connection is None:
+            self.connection = get_connection(backend=self.backend, fail_silently=False)
+            self.connection.open()
+            self.n_sent_on_connection = 0
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except (smtplib.SMTPException, socket.error):
+                pass # dropped already: nothing to tidy up
+            self.connection = None
+
+    # sends one message, returns None on success or the error (as a string) if it couldn't be sent
+    def send(self, message):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                self.open()
+                message.connection = self.connection
+                self.connection.send_messages([message])
+                self.n_sent_on_connection += 1
+                self.n_sent += 1
+                return None
+            except smtplib.SMTPRecipientsRefused, e:
+                error = e
+                break
+            except (smtplib.SMTPException, socket.error), e:
+                error = e
+                self.close()
+                if attempts > self.retries:
+                    break
+        self.n_failed += 1
+        return "%s: %s" % (error.__class__.__name__, error)
+
+    # makes the message (with make_message) and sends it, returns None on success or the
+    # error (as a string) if it couldn't be sent, or couldn't be made (e.g. rendering failed)
+    def render_and_send(self, make_message):
+        try:
+            message = timed(self.timer, 'render', make_message)
+        except Exception, e: # report it as a failure of this message, rather than stopping the run
+            self.n_failed += 1
+            return "%s: %s" % (e.__class__.__name__, e)
+        return timed(self.timer, 'send', self.send, message)
+
+    # items are (key, make_message) pairs, where key is whatever the caller needs
+    # to identify the message later (e.g. the alert) and make_message returns the
+    # email to send; yields a list of (key, error) for each batch as it's sent,
+    # where error is None if the message was sent
+    def send_batches(self, items):
+        batch = []
+        try:
+            for key, make_message in items:
+                batch.append((key, self.render_and_send(make_message)))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            self.close()
+
+# Like AlertMailer, but renders and sends the messages from a pool of worker
+# threads, each with its own mail connection, so a run isn't waiting on one
+# mail server round-trip at a time. The worker threads don't touch the
+# database: results come back to the calling thread a batch at a time (in
+# whatever order they finished), for it to do the bookkeeping.
+class ThreadedAlertMailer(object):
+    def __init__(self, workers, batch_size=None, retries=None, backend=None, timer=None):
+        self.batch_size = batch_size or settings.BINS_ALERT_BATCH_SIZE
+        self.mailers = [AlertMailer(batch_size, retries, backend, timer) for i in range(workers)]
+
+    @property
+    def n_sent(self):
+        return sum(mailer.n_sent for mailer in self.mailers)
+
+    @property
+    def n_failed(self):
+        return sum(mailer.n_failed for mailer in self.mailers)
+
+    def _work(self, mailer, jobs, results):
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                key, make_message = job
+                try:
+                    error = mailer.render_and_send(make_message)
+                except Exception, e: # e.g. the connection couldn't be opened: report it, don't lose the thread
+                    mailer.n_failed += 1
+                    error = "%s: %s" % (e.__class__.__name__, e)
+                results.put((key, error))
+        finally:
+            mailer.close()
+
+    def send_batches(self, items):
+        jobs = Queue.Queue()
+        results = Queue.Queue()
+        threads = []
+        for mailer in self.mailers:
+            thread = threading.Thread(target=self._work, args=(mailer, jobs, results))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        try:
+            items = iter(items)
+            while True:
+                # at most one batch is queued or in flight at a time
+                n_jobs = 0
+                for item in items:
+                    jobs.put(item)
+                    n_jobs += 1
+                    if n_jobs >= self.batch_size:
+                        break
+                if n_jobs == 0:
+                    break
+                yield [results.get() for i in range(n_jobs)]
+        finally:
+            for thread in threads:
+                jobs.put(None)
+            for thread in threads:
+                thread.join()
+
+# Spreads the sending of n_total emails evenly over window seconds from start
+# (a time.time() value), rather than sending them all at once: after each batch
+# the sender calls wait, which sleeps until that many emails are due. If the
+# sender starts late (or falls behind) it catches up without waiting.
+class AlertPacer(object):
+    def __init__(self, n_total, window, start=None, max_sleep=60):
+        self.n_total = n_total
+        self.window = window
+        if start is None:
+            start = time.time()
+        self.start = start
+        self.max_sleep = max_sleep # so keep_alive is called at least this often
+        self.n_done = 0
+
+    # returns the time (as a time.time() value) at which the next email is due
+    def get_due_time(self):
+        if self.n_total <= 0 or self.n_done >= self.n_total:
+            return self.start # all done (or more than were expected): no need to wait
+        return self.start + self.window * float(self.n_done) / self.n_total
+
+    # Counts n_done more emails as sent, then sleeps until the next one is due.
+    # keep_alive, if given, is called whenever it wakes while still waiting
+    # (e.g. to renew a lease); if it returns False the wait is abandoned and
+    # this returns False. Otherwise returns True.
+    def wait(self, n_done, keep_alive=None):
+        self.n_done += n_done
+        while True:
+            delay = self.get_due_time() - time.time()
+            if delay <= 0:
+                return True
+            time.sleep(min(delay, self.max_sleep))
+            if keep_alive is not None and not keep_alive():
+                return False
+
+# Adds up the time an alert run spends in each phase ('select', 'render',
+# 'send', 'bookkeeping'), for benchmarking. Time spent in worker threads is
+# added up over all the threads, so can come to more than the run took.
+class AlertRunTimer(object):
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        self.lock.acquire()
+        try:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+        finally:
+            self.lock.release()
+
+# calls function(*args, **kwargs), adding the time it takes to the phase on timer (if there is one)
+def timed(timer, phase, function, *args, **kwargs):
+    if timer is None:
+        return function(*args, **kwargs)
+    start = time.time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timer.add(phase, time.time() - start)
+
+# returns a mailer which sends from the given number of threads
+def get_alert_mailer(workers=1, timer=None):
+    if workers > 1:
+        return ThreadedAlertMailer(workers, timer=timer)
+    return AlertMailer(timer=timer)
@@ -0,0 +1,90 @@
+# bulk.py:
+# Batched database writes for Bin Alerts.
+#
+# Copyright (c) 2011 UK Citizens Online Democracy. All rights reserved.
+# Email: francis@mysociety.org; WWW: http://www.mysociety.org/
+
+from django.db import connection, transaction
+
+# Inserts rows into a model's table with executemany, batch_size rows at a time,
+# rather than a save() (and a round-trip) per object. Each row is a tuple of
+# values in the same order as field_names. Note this bypasses save(), so there
+# are no signals, and auto_now, auto_now_add and defaults are not applied: pass
+# every value in. db_table: the table to insert into, if not the model's own
+# (e.g. a copy of it). Returns the number of rows inserted.
+def insert_rows(model, field_names, rows, batch_size=500, db_table=None):
+    return _execute_rows(model, field_names, '', rows, batch_size, db_table)
+
+# As insert_rows, but a row whose key_names (which must have a unique
+# constraint on them) match a row already in the table updates that row's
+# update_names instead, or is left out if there are none. It's done with the
+# database's own insert-or-update statement, so nothing has to be read first,
+# and imports running at the same time don't trip over each other's rows.
+# Supported by PostgreSQL (9.5 or later), SQLite (3.24 or later) and MySQL.
+# Returns the number of rows given.
+def upsert_rows(model, field_names, rows, key_names, update_names=(), batch_size=500, db_table=None):
+    qn = connection.ops.quote_name
+    key_columns = [qn(model._meta.get_field(name).column) for name in key_names]
+    update_columns = [qn(model._meta.get_field(name).column) for name in update_names]
+    if 'mysql' in connection.settings_dict['ENGINE']:
+        if not update_columns:
+            update_columns = key_columns[:1] # setting a key to itself leaves the row alone
+        conflict = ' ON DUPLICATE KEY UPDATE ' + ', '.join('%s = VALUES(%s)' % (column, column) for column in update_columns)
+    else:
+        conflict = ' ON CONFLICT (%s) DO ' % ', '.join(key_columns)
+        if update_columns:
+            conflict += 'UPDATE SET ' + ', '.join('%s = EXCLUDED.%s' % (column, column) for column in update_columns)
+        else:
+            conflict += 'NOTHING'
+    return _execute_rows(model, field_names, conflict, rows, batch_size, db_table)
+
+# Updates the update_names of the rows whose key_names match, with executemany,
+# batch_size rows at a time. Each row is a tuple of the values of update_names
+# then key_names. The key should be indexed (e.g. unique), or each row will
+# scan the table. Returns the number of rows given.
+def update_rows(model, update_names, key_names, rows, batch_size=500):
+    qn = connection.ops.quote_name
+    update_fields = [model._meta.get_field(name) for name in update_names]
+    key_fields = [model._meta.get_field(name) for name in key_names]
+    sql = 'UPDATE %s SET %s WHERE %s' % (
+            qn(model._meta.db_table),
+            ', '.join('%s = %%s' % qn(field.column) for field in update_fields),
+            ' AND '.join('%s = %%s' % qn(field.column) for field in key_fields))
+    fields = update_fields + key_fields
+    cursor = connection.cursor()
+    n_rows = 0
+    batch = []
+    for row in rows:
+        batch.append([field.get_db_prep_save(value, connection=connection) for field, value in zip(fields, row)])
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            n_rows += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        n_rows += len(batch)
+    transaction.commit_unless_managed()
+    return n_rows
+
+def _execute_rows(model, field_names, sql_suffix, rows, batch_size, db_table):
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in field_names]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)%s' % (
+            qn(db_table or model._meta.db_table),
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+            sql_suffix)
+    cursor = connection.cursor()
+    n_rows = 0
+    batch = []
+    for row in rows:
+        batch.append([field.get_db_prep_save(value, connection=connection) for field, value in zip(fields, row)])
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            n_rows += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        n_rows += len(batch)
+    transaction.commit_unless_managed()
+    return n_rows
@@ -6,7 +6,7 @@
 
 from django import forms
 
-from binalerts.models import BinCollection, CollectionAlert, Street
+from binalerts.models import BinCollection, CollectionAlert, Street, ALERT_SLOT_CHOICES, DEFAULT_ALERT_SLOT
 
 class LocationForm(forms.Form):
     query = forms.CharField(error_messages = {
@@ -29,9 +29,11 @@ class CollectionAlertForm(forms.ModelForm):
             'required': 'Please enter your email address.',
             'invalid': 'Please enter a valid email address.'
     })
+    alert_slot = forms.TypedChoiceField(label='Send it at', choices=ALERT_SLOT_CHOICES, coerce=int,
+            initial=DEFAULT_ALERT_SLOT, empty_value=DEFAULT_ALERT_SLOT, required=False, widget=forms.RadioSelect)
 
     class Meta:
         model = CollectionAlert
-        fields = ('email',)
+        fields = ('email', 'alert_slot')
 
 
@@ -0,0 +1,98 @@
+import datetime
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+import settings # from which we get
+                 # BINS_ALERT_SLOT_WINDOW_MINUTES
+
+from binalerts.alerts import AlertPacer
+from binalerts.models import ALERT_SLOT_CHOICES, AlertMessage, AlertShardLease, CollectionAlert
+
+# how long to wait before trying again to finish a slot's sending
+RETRY_SECONDS = 60
+
+# Runs forever (start it from cron with run-with-lockfile, so it's restarted
+# if it stops), sending each alert slot's emails when the slot starts: first
+# any queued in the outbox by enqueuealerts, then any other alerts due (as
+# send-alerts does). The sending is spread over BINS_ALERT_SLOT_WINDOW_MINUTES
+# so the database and mail server don't get it all at once. Starting it late,
+# or again after it's stopped, is harmless: whatever is left of the current
+# slot is sent straight away (alerts are never sent twice). A slot isn't done
+# with until all its shards are completed and its outbox is empty: shards
+# still leased by a run which has died, and emails which couldn't be sent,
+# are tried again every RETRY_SECONDS until the next slot starts (except
+# those to refused recipients, or which have failed BINS_ALERT_MAX_ATTEMPTS
+# times, which are given up on).
+class Command(BaseCommand):
+    help = "Sends alert emails at the times of day chosen by subscribers, running until it is stopped"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help="number of threads sending emails at once (default 1)"),
+        make_option('--window', dest='window', type='int', default=None,
+                    help="minutes over which to spread each slot's emails (default BINS_ALERT_SLOT_WINDOW_MINUTES)"),
+        make_option('--once', dest='once', action='store_true', default=False,
+                    help="just send whatever is due in the current slot, then stop"),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        window = options['window']
+        if window is None:
+            window = settings.BINS_ALERT_SLOT_WINDOW_MINUTES
+        if window < 0:
+            raise CommandError("--window can't be negative")
+
+        done = None # (date, slot) most recently sent
+        while True:
+            now = datetime.datetime.now()
+            slot = CollectionAlert.objects.get_slot(now)
+            if slot is not None and (now.date(), slot) != done:
+                self.send_slot(now, slot, window * 60, options['workers'])
+                while not options['once'] and not self.is_slot_sent(now.date(), slot):
+                    seconds_to_next_slot = self.get_seconds_to_next_slot(datetime.datetime.now())
+                    if seconds_to_next_slot <= RETRY_SECONDS:
+                        sys.stderr.write("gave up on the rest of the %s slot's alert emails\n" % dict(ALERT_SLOT_CHOICES)[slot])
+                        break
+                    transaction.commit_unless_managed()
+                    time.sleep(RETRY_SECONDS)
+                    self.send_slot(now, slot, window * 60, options['workers'])
+                done = (now.date(), slot)
+            if options['once']:
+                break
+            time.sleep(self.get_seconds_to_next_slot(datetime.datetime.now()))
+
+    def send_slot(self, now, slot, window, workers):
+        today = now.date()
+        slot_start = datetime.datetime.combine(today, datetime.time(slot))
+        n_due = AlertMessage.objects.count_alerts_due(today, slot) + CollectionAlert.objects.count_alerts_due(today, slot)
+        pacer = AlertPacer(n_due, window, start=time.mktime(slot_start.timetuple()))
+        print "%s: sending %s alert emails for the %s slot" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), n_due, dict(ALERT_SLOT_CHOICES)[slot])
+        sys.stdout.flush()
+
+        n_sent, n_failed = AlertMessage.objects.drain_alerts(today, workers=workers, slot=slot, pacer=pacer)
+        if n_failed:
+            sys.stderr.write("%s alert emails in the outbox couldn't be sent\n" % n_failed)
+        CollectionAlert.objects.send_pending_alerts(now=now, workers=workers, slot=slot, pacer=pacer)
+        # don't sit in an open transaction until the next slot
+        transaction.commit_unless_managed()
+
+    # whether every shard of the slot's alerts is completed, and every email due by it in the outbox is sent
+    @staticmethod
+    def is_slot_sent(today, slot):
+        return not AlertShardLease.objects.get_incomplete_leases(today, slot) and not AlertMessage.objects.count_alerts_unsent(today, slot)
+
+    # seconds until the next slot starts (tomorrow's first slot, after the last one today)
+    @staticmethod
+    def get_seconds_to_next_slot(now):
+        today = now.date()
+        slot_starts = [datetime.datetime.combine(today, datetime.time(slot)) for slot, slot_name in ALERT_SLOT_CHOICES]
+        slot_starts.append(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time(ALERT_SLOT_CHOICES[0][0])))
+        next_start = min(start for start in slot_starts if start > now)
+        delta = next_start - now
+        return delta.days * 86400 + delta.seconds + 1
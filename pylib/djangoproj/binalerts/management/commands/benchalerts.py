@@ -0,0 +1,115 @@
+import datetime
+import resource
+import time
+from optparse import make_option
+
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection, reset_queries, transaction
+
+from emailconfirmation.models import EmailConfirmation
+
+from binalerts.alerts import AlertRunTimer
+from binalerts.bulk import insert_rows
+from binalerts.models import BinCollection, BinCollectionType, CollectionAlert, Street
+
+PHASES = ('select', 'render', 'send', 'bookkeeping')
+
+# Measures send_pending_alerts at a realistic scale. Creates a throwaway test
+# database (as the test runner does), fills it with streets, collections and
+# confirmed alerts, runs the alerts for a day with Django's dummy email backend
+# (or an SMTP server, e.g. python -m smtpd -n -c DebuggingServer localhost:1025)
+# and reports how long it took, and in what. The real database isn't touched.
+class Command(BaseCommand):
+    help = "Benchmarks sending alerts, on made-up streets and alerts in a throwaway database"
+    option_list = BaseCommand.option_list + (
+        make_option('--alerts', dest='alerts', type='int', default=1000,
+                    help="number of confirmed alerts to make (default 1000)"),
+        make_option('--streets', dest='streets', type='int', default=None,
+                    help="number of streets to spread them over (default a tenth as many as alerts)"),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help="number of threads sending emails at once (default 1)"),
+        make_option('--smtp', dest='smtp', default=None,
+                    help="send the emails to the SMTP server at HOST:PORT, rather than throwing them away"),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+                    help="don't ask before deleting an old test database"),
+    )
+
+    def handle(self, *args, **options):
+        n_alerts = options['alerts']
+        n_streets = options['streets'] or max(1, n_alerts / 10)
+        if n_alerts < 1 or n_streets < 1:
+            raise CommandError("--alerts and --streets must be at least 1")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options['smtp']:
+            try:
+                email_host, email_port = options['smtp'].split(':')
+                email_port = int(email_port)
+            except ValueError:
+                raise CommandError("--smtp must be HOST:PORT, not %s" % options['smtp'])
+            django_settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+            django_settings.EMAIL_HOST = email_host
+            django_settings.EMAIL_PORT = email_port
+        else:
+            django_settings.EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+
+        today = datetime.date(2010, 1, 4) # any day will do
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        try:
+            start = time.time()
+            self.make_alerts(today, n_streets, n_alerts)
+            print "made %s alerts on %s streets in %.1fs" % (n_alerts, n_streets, time.time() - start)
+            self.run_alerts(today, options['workers'])
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    # Every street has one collection. Three in four are collected tomorrow, so
+    # their alerts are sent; the rest have nothing due, so are just checked.
+    @transaction.commit_on_success
+    def make_alerts(self, today, n_streets, n_alerts):
+        tomorrow_day_of_week, tomorrow_day_name = CollectionAlert.objects.get_tomorrow(today)
+        collection_types = list(BinCollectionType.objects.all())
+        if not collection_types:
+            collection_types = [BinCollectionType.objects.create(description='Benchmark waste', friendly_id='B')]
+
+        insert_rows(Street, ('name', 'url_name', 'partial_postcode'),
+                (('Benchmark Street %d' % i, 'benchmark_street_%d' % i, 'XX0') for i in xrange(n_streets)))
+        street_ids = list(Street.objects.filter(url_name__startswith='benchmark_street_').order_by('id').values_list('id', flat=True))
+
+        days = [tomorrow_day_of_week] * 3 + [(tomorrow_day_of_week + 1) % 7]
+        now = datetime.datetime.now()
+        insert_rows(BinCollection, ('street', 'collection_day', 'collection_type', 'last_updated'),
+                ((street_id, days[i % 4], collection_types[i % len(collection_types)].id, now)
+                    for i, street_id in enumerate(street_ids)))
+
+        insert_rows(CollectionAlert, ('email', 'street', 'last_checked_date', 'alert_slot'),
+                (('subscriber%d@example.com' % i, street_ids[i % len(street_ids)], datetime.date(2000, 1, 1), 9)
+                    for i in xrange(n_alerts)))
+        for collection_alert in CollectionAlert.objects.filter(email__endswith='@example.com').iterator():
+            EmailConfirmation.objects.create(confirmed = True, content_object = collection_alert)
+
+    def run_alerts(self, today, workers):
+        django_settings.DEBUG = True # so the queries are counted in connection.queries
+        reset_queries()
+        timer = AlertRunTimer()
+        max_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.time()
+        CollectionAlert.objects.send_pending_alerts(now=datetime.datetime.combine(today, datetime.time(9)), workers=workers, timer=timer)
+        elapsed = time.time() - start
+
+        n_queries = len(connection.queries)
+        django_settings.DEBUG = False
+        max_rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        n_sent = CollectionAlert.objects.filter(last_sent_date=today).count()
+
+        print "sent %s alerts with %s workers in %.2fs: %.1f alerts/sec" % (n_sent, workers, elapsed, n_sent / max(elapsed, 0.001))
+        print "queries: %s" % n_queries
+        print "peak memory: %.1f MB (%.1f MB before the run)" % (max_rss_after / 1024.0, max_rss_before / 1024.0)
+        for phase in PHASES:
+            print "  %-12s %8.2fs" % (phase, timer.seconds.get(phase, 0.0))
+        if workers > 1:
+            print "(render and send times are added up over all the worker threads)"
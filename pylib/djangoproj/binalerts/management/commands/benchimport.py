@@ -0,0 +1,185 @@
+import datetime
+import json
+import os
+import resource
+import time
+from optparse import make_option
+
+import binalerts
+import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from binalerts.alerts import AlertRunTimer
+from binalerts.management.commands.importdata import DEFAULT_COLLECTION_TYPES
+from binalerts.models import BinCollectionType, DataImport, ImportRun
+
+STAGES = ('parse', 'normalise', 'match', 'write')
+
+# the Barnet files, in the order they're imported (garden waste first, as it has the postcodes)
+BARNET_FILES = (
+    'garden-and-kitchen-waste-collection-streets.xml',
+    'refuse_rounds_road_day.csv',
+    'recycling.csv',
+)
+
+# Counts the queries run through a connection's cursors, while started, without
+# keeping their SQL as connection.queries does with DEBUG on (which would take
+# up memory in proportion to the number of queries, and so inflate the peak
+# memory measured alongside).
+class QueryCounter(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.n_queries = 0
+
+    def start(self):
+        make_cursor = self.connection.cursor
+        self.connection.cursor = lambda: CountingCursor(make_cursor(), self)
+
+    def stop(self):
+        del self.connection.cursor # back to the class's
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.counter.n_queries += 1
+        return self.cursor.execute(sql, params)
+
+    # one query, as connection.queries counts it
+    def executemany(self, sql, param_list):
+        self.counter.n_queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+# Measures importing the real-sized Barnet files in fixtures/barnet (or the
+# files given) with DataImport.load_from_files, into a throwaway test database
+# (as the test runner makes, so the real database isn't touched). Reports
+# rows/sec, SQL queries, peak memory and the time taken in each stage, and
+# can save them as JSON, and compare them with JSON saved earlier, e.g.
+#     ./manage.py benchimport --output baseline.json
+#     ... change things ...
+#     ./manage.py benchimport --baseline baseline.json
+# which fails if the import has got slower (or bigger) by more than --tolerance.
+class Command(BaseCommand):
+    help = "Benchmarks importing the Barnet data files (or those given), in a throwaway database"
+    args = "[file ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help="number of processes to parse the files in (default 1)"),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help="rows per batched database write (default 500)"),
+        make_option('--cached', dest='cached', action='store_true', default=False,
+                    help="use the cache of rows read from pdftohtml XML files in BINS_IMPORT_CACHE_DIR (default: parse them afresh)"),
+        make_option('--output', dest='output', default=None,
+                    help="save the results as JSON in this file"),
+        make_option('--baseline', dest='baseline', default=None,
+                    help="compare the results with those saved (by --output) in this file"),
+        make_option('--tolerance', dest='tolerance', type='float', default=20.0,
+                    help="percentage worse than the baseline which counts as a regression (default 20)"),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+                    help="don't ask before deleting an old test database"),
+    )
+
+    def handle(self, *args, **options):
+        if options['jobs'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--jobs and --batch-size must be at least 1")
+        file_names = list(args) or [os.path.join(os.path.dirname(binalerts.__file__), 'fixtures/barnet', name) for name in BARNET_FILES]
+        for file_name in file_names:
+            if not os.path.exists(file_name):
+                raise CommandError("no such file: %s" % file_name)
+        baseline = None
+        if options['baseline']:
+            baseline = json.load(open(options['baseline']))
+        if options['cached'] and not settings.BINS_IMPORT_CACHE_DIR:
+            raise CommandError("--cached needs BINS_IMPORT_CACHE_DIR to be set")
+        if not options['cached']:
+            settings.BINS_IMPORT_CACHE_DIR = ''
+
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        try:
+            results = self.run_import(file_names, options['jobs'], options['batch_size'])
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        print "%s file(s): %s rows read in %.2fs: %.1f rows/sec" % (len(file_names), results['rows'], results['seconds'], results['rows_per_sec'])
+        print "bin collections loaded: %s, new streets created: %s, errors: %s" % (results['collections'], results['new_streets'], results['errors'])
+        print "queries: %s" % results['queries']
+        print "peak memory: %.1f MB" % results['peak_rss_mb']
+        for stage in STAGES:
+            print "  %-12s %8.2fs" % (stage, results['stages'][stage])
+        if options['jobs'] > 1:
+            print "(parse is the time waiting for the parsing processes, and includes normalise)"
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                json.dump(results, output, indent=4, sort_keys=True)
+            finally:
+                output.close()
+        if baseline is not None:
+            regressions = self.compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError("worse than the baseline in %s:\n%s" % (options['baseline'], "\n".join(regressions)))
+            print "no worse than the baseline in %s (within %s%%)" % (options['baseline'], options['tolerance'])
+
+    def run_import(self, file_names, jobs, batch_size):
+        files = [(file_name, BinCollectionType.objects.get(friendly_id=DEFAULT_COLLECTION_TYPES[DataImport.get_file_kind(file_name)]))
+                for file_name in file_names]
+        run = ImportRun.objects.create(description="benchimport", started=datetime.datetime.now())
+        timer = AlertRunTimer()
+        counter = QueryCounter(connection)
+        counter.start()
+        try:
+            start = time.time()
+            DataImport.load_from_files(files, guess_postcodes=True, run=run, workers=jobs, batch_size=batch_size, timer=timer)
+            elapsed = time.time() - start
+        finally:
+            counter.stop()
+
+        run = ImportRun.objects.get(id=run.id)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if jobs > 1:
+            peak_rss = max(peak_rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        stages = dict((stage, timer.seconds.get(stage, 0.0)) for stage in STAGES)
+        if jobs == 1:
+            stages['parse'] -= stages['normalise'] # it's timed within parsing
+        return {
+            'files': [os.path.basename(file_name) for file_name in file_names],
+            'jobs': jobs,
+            'batch_size': batch_size,
+            'rows': run.n_rows,
+            'collections': run.n_collections,
+            'new_streets': run.n_new_streets,
+            'errors': run.n_errors,
+            'seconds': elapsed,
+            'rows_per_sec': run.n_rows / max(elapsed, 0.001),
+            'queries': counter.n_queries,
+            'peak_rss_mb': peak_rss / 1024.0,
+            'stages': stages,
+        }
+
+    # returns a description of each way the results are worse than the baseline, by more than tolerance percent
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        if results['files'] != baseline['files']:
+            raise CommandError("the baseline is of different files: %s" % ", ".join(baseline['files']))
+        if results['rows_per_sec'] < baseline['rows_per_sec'] * (1 - tolerance / 100.0):
+            regressions.append("rows/sec: %.1f, was %.1f" % (results['rows_per_sec'], baseline['rows_per_sec']))
+        for name in ('queries', 'peak_rss_mb'):
+            if results[name] > baseline[name] * (1 + tolerance / 100.0):
+                regressions.append("%s: %s, was %s" % (name, results[name], baseline[name]))
+        for stage in STAGES:
+            # ignore stages which are too quick to time reliably
+            if results['stages'][stage] > 0.1 and results['stages'][stage] > baseline['stages'].get(stage, 0.0) * (1 + tolerance / 100.0):
+                regressions.append("%s stage: %.2fs, was %.2fs" % (stage, results['stages'][stage], baseline['stages'].get(stage, 0.0)))
+        return regressions
@@ -0,0 +1,29 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from binalerts.models import AlertMessage
+
+class Command(BaseCommand):
+    help = "Sends the alert emails in the outbox (queued by enqueuealerts) which are due to be sent on a day"
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date', default=None,
+                    help="send the emails queued for this day, as YYYY-MM-DD (default: today)"),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help="number of threads sending emails at once (default 1)"),
+    )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                send_date = datetime.datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--date must be YYYY-MM-DD, not %s" % options['date'])
+        else:
+            send_date = datetime.date.today()
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        n_sent, n_failed = AlertMessage.objects.drain_alerts(send_date, workers=options['workers'])
+        print "sent %s alert emails for %s, %s failed (left in the outbox)" % (n_sent, send_date, n_failed)
@@ -0,0 +1,25 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from binalerts.models import AlertMessage
+
+class Command(BaseCommand):
+    help = "Renders the alert emails to be sent on a day into the outbox, for drainalerts to send"
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date', default=None,
+                    help="day the emails are to be sent, as YYYY-MM-DD (default: tomorrow, so this can run the evening before)"),
+    )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                send_date = datetime.datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--date must be YYYY-MM-DD, not %s" % options['date'])
+        else:
+            send_date = datetime.date.today() + datetime.timedelta(days=1)
+        n_messages = AlertMessage.objects.enqueue_alerts(send_date)
+        print "queued %s alert emails to send on %s" % (n_messages, send_date)
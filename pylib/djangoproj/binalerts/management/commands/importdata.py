@@ -0,0 +1,101 @@
+import cProfile
+import datetime
+import glob
+import pstats
+import resource
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from binalerts.models import BinCollectionType, DataImport, ImportRun
+
+# collection types of rows which don't give one, by file kind (as the DataImport admin)
+DEFAULT_COLLECTION_TYPES = { 'CSV': 'D', 'XML': 'G' }
+
+# Imports collection data files from the command line, e.g.
+#     ./manage.py importdata --guess-postcodes --jobs 3 fixtures/barnet/*.xml fixtures/barnet/*.csv
+# Each file is either a CSV file or one made by "pdftohtml -xml" (told apart by
+# extension, or else by looking at it). The files are imported together, in
+# the order given, in bulk and in one transaction (see DataImport.load_from_files).
+# The report is stored as an ImportRun, for looking at in the admin.
+class Command(BaseCommand):
+    help = "Imports bin collection data from CSV and pdftohtml XML files, all in one go"
+    args = "file_or_glob [file_or_glob ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--type', dest='type', default=None,
+                    help="friendly id of the collection type for rows which don't give one (default D for CSV files, G for XML)"),
+        make_option('--guess-postcodes', dest='guess_postcodes', action='store_true', default=False,
+                    help="guess missing postcodes from existing streets of the same name"),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help="rows per batched database write (default 500)"),
+        make_option('--jobs', dest='jobs', type='int', default=1,
+                    help="number of processes to parse the files in (default 1)"),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help="work out and report the changes, but don't write them"),
+        make_option('--full', dest='incremental', action='store_false', default=True,
+                    help="import every row, even those unchanged since the file was last imported"),
+        make_option('--shadow', dest='shadow', action='store_true', default=False,
+                    help="build the new data in copies of the tables, then swap them in at the end (PostgreSQL only)"),
+        make_option('--profile', dest='profile', action='store_true', default=False,
+                    help="profile the import, and print where the time went"),
+    )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['jobs'] < 1:
+            raise CommandError("--batch-size and --jobs must be at least 1")
+        if options['shadow'] and 'postgresql' not in connection.settings_dict['ENGINE']:
+            raise CommandError("--shadow needs PostgreSQL")
+        file_names = []
+        for arg in args:
+            matches = sorted(glob.glob(arg))
+            if not matches:
+                raise CommandError("no files found: %s" % arg)
+            file_names.extend(matches)
+        if not file_names:
+            raise CommandError("give the files to import")
+        files = [(file_name, self.get_collection_type(options['type'] or DEFAULT_COLLECTION_TYPES[DataImport.get_file_kind(file_name)]))
+                for file_name in file_names]
+        verbosity = int(options.get('verbosity', 1))
+
+        description = "importdata: %s" % ", ".join(file_names)
+        if options['dry_run']:
+            description += " (dry run)"
+        run = ImportRun.objects.create(description=description[:255], started=datetime.datetime.now())
+        load_options = dict(guess_postcodes=options['guess_postcodes'], incremental=options['incremental'], run=run,
+                workers=options['jobs'], dry_run=options['dry_run'], batch_size=options['batch_size'], shadow=options['shadow'])
+        start = time.time()
+        if options['profile']:
+            profiler = cProfile.Profile()
+            profiler.runcall(DataImport.load_from_files, files, **load_options)
+        else:
+            DataImport.load_from_files(files, **load_options)
+        elapsed = time.time() - start
+        run = ImportRun.objects.get(id=run.id)
+
+        if verbosity >= 2:
+            for event in run.events.exclude(severity='info').iterator():
+                print "%s: %s" % (event.get_severity_display(), event.message)
+        print "%s file(s): %s rows read in %.2fs: %.1f rows/sec" % (len(files), run.n_rows, elapsed, run.n_rows / max(elapsed, 0.001))
+        print "rows unchanged since the last import: %s" % run.n_skipped
+        if options['dry_run']:
+            # the change plan is at the end of the report
+            plan_start = run.events.get(message__startswith='dry run:').seq
+            for event in run.events.filter(seq__gte=plan_start):
+                print event.message
+        print "bin collections loaded: %s" % run.n_collections
+        print "new streets created: %s" % run.n_new_streets
+        print "warnings: %s, errors: %s (see import run %s in the admin)" % (run.n_warnings, run.n_errors, run.id)
+        print "peak memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+        if options['jobs'] > 1:
+            print "(not including the memory used by the parsing processes)"
+        if options['profile']:
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+    def get_collection_type(self, friendly_id):
+        try:
+            return BinCollectionType.objects.get(friendly_id=friendly_id)
+        except BinCollectionType.DoesNotExist:
+            raise CommandError("no collection type with friendly id %s" % friendly_id)
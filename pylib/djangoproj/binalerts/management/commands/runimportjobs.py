@@ -0,0 +1,38 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from binalerts.models import AlertShardLease, ImportJob
+
+# Runs the imports queued from the DataImport admin, one at a time, waiting
+# for more when there are none (start it from cron with run-with-lockfile, so
+# it's restarted if it stops).
+class Command(BaseCommand):
+    help = "Runs queued data imports, waiting for more until it is stopped"
+    option_list = BaseCommand.option_list + (
+        make_option('--once', dest='once', action='store_true', default=False,
+                    help="run whatever imports are queued, then stop"),
+        make_option('--sleep', dest='sleep', type='int', default=10,
+                    help="seconds to wait between looking for new jobs (default 10)"),
+    )
+
+    def handle(self, *args, **options):
+        if options['sleep'] < 1:
+            raise CommandError("--sleep must be at least 1")
+        holder = AlertShardLease.make_holder_name()
+        while True:
+            job = ImportJob.objects.claim_next(holder)
+            if job:
+                job.run()
+                print "%s: %s rows, %s new streets, %s errors" % (job, job.n_rows, job.n_new_streets, job.n_errors)
+                sys.stdout.flush()
+                continue
+            if options['once']:
+                break
+            # don't sit in an open transaction while waiting
+            transaction.commit_unless_managed()
+            time.sleep(options['sleep'])
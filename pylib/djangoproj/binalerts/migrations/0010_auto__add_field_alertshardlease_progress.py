@@ -0,0 +1,139 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'AlertShardLease.claimed'
+        db.add_column('binalerts_alertshardlease', 'claimed', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'AlertShardLease.finished'
+        db.add_column('binalerts_alertshardlease', 'finished', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'AlertShardLease.last_alert_id'
+        db.add_column('binalerts_alertshardlease', 'last_alert_id', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'AlertShardLease.n_checked'
+        db.add_column('binalerts_alertshardlease', 'n_checked', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'AlertShardLease.n_sent'
+        db.add_column('binalerts_alertshardlease', 'n_sent', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'AlertShardLease.n_failed'
+        db.add_column('binalerts_alertshardlease', 'n_failed', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'AlertShardLease.claimed'
+        db.delete_column('binalerts_alertshardlease', 'claimed')
+
+        # Deleting field 'AlertShardLease.finished'
+        db.delete_column('binalerts_alertshardlease', 'finished')
+
+        # Deleting field 'AlertShardLease.last_alert_id'
+        db.delete_column('binalerts_alertshardlease', 'last_alert_id')
+
+        # Deleting field 'AlertShardLease.n_checked'
+        db.delete_column('binalerts_alertshardlease', 'n_checked')
+
+        # Deleting field 'AlertShardLease.n_sent'
+        db.delete_column('binalerts_alertshardlease', 'n_sent')
+
+        # Deleting field 'AlertShardLease.n_failed'
+        db.delete_column('binalerts_alertshardlease', 'n_failed')
+
+
+    models = {
+        'binalerts.alertmessage': {
+            'Meta': {'ordering': "('-send_date', 'email')", 'unique_together': "(('alert', 'send_date'),)", 'object_name': 'AlertMessage'},
+            'alert': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'to': "orm['binalerts.CollectionAlert']"}),
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'holder': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'send_date': ('django.db.models.fields.DateField', [], {}),
+            'sent': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'binalerts.alertshardlease': {
+            'Meta': {'ordering': "('-run_date', 'shard')", 'unique_together': "(('run_date', 'shard'),)", 'object_name': 'AlertShardLease'},
+            'claimed': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'completed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'holder': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_alert_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_checked': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_failed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_sent': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'run_date': ('django.db.models.fields.DateField', [], {}),
+            'shard': ('django.db.models.fields.IntegerField', [], {}),
+            'street_id_from': ('django.db.models.fields.IntegerField', [], {}),
+            'street_id_to': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'binalerts.bincollection': {
+            'Meta': {'ordering': "['street__name', 'collection_day', 'collection_type__friendly_id']", 'object_name': 'BinCollection'},
+            'collection_day': ('django.db.models.fields.IntegerField', [], {}),
+            'collection_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.BinCollectionType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bin_collections'", 'to': "orm['binalerts.Street']"})
+        },
+        'binalerts.bincollectiontype': {
+            'Meta': {'object_name': 'BinCollectionType'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'detail_text': ('django.db.models.fields.TextField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'friendly_id': ('django.db.models.fields.CharField', [], {'max_length': '4'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'binalerts.collectionalert': {
+            'Meta': {'ordering': "('email',)", 'object_name': 'CollectionAlert'},
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_checked_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date(2000, 1, 1)'}),
+            'last_sent_date': ('django.db.models.fields.DateField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.Street']", 'null': 'True'})
+        },
+        'binalerts.dataimport': {
+            'Meta': {'object_name': 'DataImport'},
+            'guess_postcodes': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'implicit_collection_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.BinCollectionType']", 'null': 'True', 'blank': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'upload_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100'})
+        },
+        'binalerts.street': {
+            'Meta': {'ordering': "['name', 'partial_postcode']", 'object_name': 'Street'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'partial_postcode': ('django.db.models.fields.CharField', [], {'max_length': '5'}),
+            'url_name': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'emailconfirmation.emailconfirmation': {
+            'Meta': {'object_name': 'EmailConfirmation'},
+            'confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'page_after': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['binalerts']
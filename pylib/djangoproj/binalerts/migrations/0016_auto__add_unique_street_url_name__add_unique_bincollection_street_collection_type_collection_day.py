@@ -0,0 +1,218 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # The existing data may break the new unique keys, so tidy it up first
+        if not db.dry_run:
+            self.remove_duplicate_streets(orm)
+            self.remove_duplicate_collections(orm)
+
+        # Adding unique constraint on 'Street', fields ['url_name']
+        db.create_unique('binalerts_street', ['url_name'])
+
+        # Adding unique constraint on 'BinCollection', fields ['street', 'collection_type', 'collection_day']
+        db.create_unique('binalerts_bincollection', ['street_id', 'collection_type_id', 'collection_day'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'BinCollection', fields ['street', 'collection_type', 'collection_day']
+        db.delete_unique('binalerts_bincollection', ['street_id', 'collection_type_id', 'collection_day'])
+
+        # Removing unique constraint on 'Street', fields ['url_name']
+        db.delete_unique('binalerts_street', ['url_name'])
+
+
+    # Streets with the same url name are merged into the oldest if they're the
+    # same street (same name, ignoring case, and postcode), moving their
+    # collections and alerts over; otherwise the later ones are numbered
+    # (e.g. high_street_nw4_2) as StreetManager.make_unique_url_name does.
+    def remove_duplicate_streets(self, orm):
+        streets_by_url_name = {}
+        for street in orm['binalerts.Street'].objects.order_by('id'):
+            streets_by_url_name.setdefault(street.url_name, []).append(street)
+        url_names = set(streets_by_url_name.keys())
+        for url_name, streets in streets_by_url_name.items():
+            kept = {}
+            for street in streets:
+                key = (street.name.upper(), street.partial_postcode)
+                if key in kept:
+                    orm['binalerts.BinCollection'].objects.filter(street=street).update(street=kept[key])
+                    orm['binalerts.CollectionAlert'].objects.filter(street=street).update(street=kept[key])
+                    street.delete()
+                    continue
+                if kept:
+                    n = 1
+                    new_url_name = url_name
+                    while new_url_name in url_names:
+                        n += 1
+                        suffix = '_%d' % n
+                        new_url_name = url_name[:50 - len(suffix)] + suffix
+                    street.url_name = new_url_name
+                    street.save()
+                    url_names.add(new_url_name)
+                kept[key] = street
+
+    # Only the oldest of the collections on the same street, of the same type and day, is kept
+    def remove_duplicate_collections(self, orm):
+        seen = set()
+        duplicate_ids = []
+        for collection_id, street_id, collection_type_id, collection_day in orm['binalerts.BinCollection'].objects.order_by('id').values_list('id', 'street', 'collection_type', 'collection_day'):
+            key = (street_id, collection_type_id, collection_day)
+            if key in seen:
+                duplicate_ids.append(collection_id)
+            seen.add(key)
+        for i in range(0, len(duplicate_ids), 500):
+            orm['binalerts.BinCollection'].objects.filter(id__in=duplicate_ids[i:i + 500]).delete()
+
+
+    models = {
+        'binalerts.alertmessage': {
+            'Meta': {'ordering': "('-send_date', 'email')", 'unique_together': "(('alert', 'send_date'),)", 'object_name': 'AlertMessage'},
+            'alert': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'messages'", 'to': "orm['binalerts.CollectionAlert']"}),
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'holder': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'send_date': ('django.db.models.fields.DateField', [], {}),
+            'sent': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'subject': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'binalerts.alertshardlease': {
+            'Meta': {'ordering': "('-run_date', 'slot', 'shard')", 'unique_together': "(('run_date', 'slot', 'shard'),)", 'object_name': 'AlertShardLease'},
+            'claimed': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'completed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'expires': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'holder': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_alert_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_checked': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_failed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_sent': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'run_date': ('django.db.models.fields.DateField', [], {}),
+            'shard': ('django.db.models.fields.IntegerField', [], {}),
+            'slot': ('django.db.models.fields.IntegerField', [], {'default': '9'}),
+            'street_id_from': ('django.db.models.fields.IntegerField', [], {}),
+            'street_id_to': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'binalerts.bincollection': {
+            'Meta': {'ordering': "['street__name', 'collection_day', 'collection_type__friendly_id']", 'unique_together': "(('street', 'collection_type', 'collection_day'),)", 'object_name': 'BinCollection'},
+            'collection_day': ('django.db.models.fields.IntegerField', [], {}),
+            'collection_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.BinCollectionType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'bin_collections'", 'to': "orm['binalerts.Street']"})
+        },
+        'binalerts.bincollectiontype': {
+            'Meta': {'object_name': 'BinCollectionType'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'detail_text': ('django.db.models.fields.TextField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'friendly_id': ('django.db.models.fields.CharField', [], {'max_length': '4'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'binalerts.collectionalert': {
+            'Meta': {'ordering': "('email',)", 'object_name': 'CollectionAlert'},
+            'alert_slot': ('django.db.models.fields.IntegerField', [], {'default': '9'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_checked_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date(2000, 1, 1)'}),
+            'last_sent_date': ('django.db.models.fields.DateField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.Street']", 'null': 'True'})
+        },
+        'binalerts.dataimport': {
+            'Meta': {'object_name': 'DataImport'},
+            'guess_postcodes': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'implicit_collection_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.BinCollectionType']", 'null': 'True', 'blank': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'auto_now_add': 'True', 'null': 'True', 'blank': 'True'}),
+            'upload_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100'})
+        },
+        'binalerts.importjob': {
+            'Meta': {'ordering': "('-created',)", 'object_name': 'ImportJob'},
+            'created': ('django.db.models.fields.DateTimeField', [], {}),
+            'data_import': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.DataImport']", 'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'dry_run': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'holder': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'import_run': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['binalerts.ImportRun']", 'null': 'True', 'blank': 'True'}),
+            'n_errors': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_new_streets': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_rows': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'report': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '10'})
+        },
+        'binalerts.importevent': {
+            'Meta': {'ordering': "('run', 'seq')", 'object_name': 'ImportEvent'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'line': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {}),
+            'run': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'events'", 'to': "orm['binalerts.ImportRun']"}),
+            'seq': ('django.db.models.fields.IntegerField', [], {}),
+            'severity': ('django.db.models.fields.CharField', [], {'default': "'info'", 'max_length': '10', 'db_index': 'True'}),
+            'street_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'binalerts.importrowdigest': {
+            'Meta': {'unique_together': "(('source', 'digest'),)", 'object_name': 'ImportRowDigest'},
+            'digest': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'row_digests'", 'to': "orm['binalerts.ImportSource']"})
+        },
+        'binalerts.importrun': {
+            'Meta': {'ordering': "('-started',)", 'object_name': 'ImportRun'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'n_collections': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_errors': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_new_streets': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_rows': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_skipped': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'n_warnings': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'started': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'binalerts.importsource': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'ImportSource'},
+            'file_digest': ('django.db.models.fields.CharField', [], {'max_length': '40', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_imported': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        'binalerts.street': {
+            'Meta': {'ordering': "['name', 'partial_postcode']", 'object_name': 'Street'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'partial_postcode': ('django.db.models.fields.CharField', [], {'max_length': '5'}),
+            'url_name': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'emailconfirmation.emailconfirmation': {
+            'Meta': {'object_name': 'EmailConfirmation'},
+            'confirmed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'page_after': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['binalerts']
@@ -6,24 +6,42 @@
 
 import datetime
 import sys
-import xml.dom.minidom
+from xml.etree.cElementTree import iterparse
 import re
 import csv
+import cPickle
+import os
 import os.path
+import socket
+import tempfile
+import uuid
 import hashlib
+import functools
+import multiprocessing
+import time
+import traceback
 
 import settings # from which we get
                  # BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK
                  # BINS_STREETS_MUST_HAVE_POSTCODE
+                 # BINS_ALERT_SHARDS
+                 # BINS_ALERT_LEASE_SECONDS
+                 # BINS_ALERT_BATCH_SIZE
+                 # BINS_ALERT_MAX_ATTEMPTS
 
 from django.db import models
+from django.db import connection
 from django.db import IntegrityError
+from django.db import transaction
 from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.template import Context
+from django.core.mail import EmailMessage
 
 from emailconfirmation.models import EmailConfirmation
-from emailconfirmation.utils import send_email
+
+from binalerts.alerts import AlertRenderCache, get_alert_mailer, is_permanent_failure, timed
+from binalerts.bulk import insert_rows, update_rows, upsert_rows
 
 from utils import canonicalise_postcode
 
@@ -39,6 +57,14 @@ DAY_OF_WEEK_CHOICES = (
     (5, 'Friday'),
     (6, 'Saturday')
 )
+DAY_NUMBERS_BY_NAME = dict((name, number) for number, name in DAY_OF_WEEK_CHOICES)
+
+# times of day (hours) at which alerts can be sent, as chosen by the subscriber
+ALERT_SLOT_CHOICES = (
+    (9, '9am'),
+    (18, '6pm')
+)
+DEFAULT_ALERT_SLOT = 9
 
 
 class BinCollectionType(models.Model):
@@ -62,7 +88,8 @@ class StreetManager(models.Manager):
     # add a street to the database (this is via update: a little dangerous if this isn't used in admin street creation)
     # raises IntegrityError if there's a problem (similar to get_or_create), containing useful message
     # returns street, bool was created, bool guessed_postcode
-    def get_or_create_street(self, name, partial_postcode=None, guess_postcodes=False):
+    # postcode_index: a StreetPostcodeIndex to guess postcodes from (rather than a query for each street), kept up to date
+    def get_or_create_street(self, name, partial_postcode=None, guess_postcodes=False, postcode_index=None):
         if not partial_postcode:
             partial_postcode = '' # empty string since not null is enforced
         if not name:
@@ -70,7 +97,10 @@ class StreetManager(models.Manager):
         did_guess_postcode = False
         candidate_streets = self.filter(name__iexact=name)
         if not partial_postcode:
-            postcodes = candidate_streets.exclude(partial_postcode='').values_list('partial_postcode', flat=True)
+            if postcode_index is not None:
+                postcodes = postcode_index.get_postcodes(name)
+            else:
+                postcodes = self.get_postcodes_for_name(name)
             if len(postcodes) == 1 and guess_postcodes:
                 partial_postcode = postcodes[0]
                 did_guess_postcode = True
@@ -90,14 +120,35 @@ class StreetManager(models.Manager):
             msg = '"%s" is ambiguous, %s possibilities: %s' % (name, len(candidate_streets), " or ".join('"' + s.__unicode__() + '"' for s in candidate_streets))
             raise IntegrityError(msg)
         else:
-            url_name = Street.make_url_name(name, partial_postcode)
+            url_name = self.make_unique_url_name(name, partial_postcode)
             street = Street(name=name, url_name=url_name, partial_postcode=partial_postcode)
             street.save()
+            if postcode_index is not None:
+                postcode_index.add(name, partial_postcode)
             return (street, True, did_guess_postcode) 
 
+    # url_name is unique, but streets with the same name and postcode apart from
+    # case or spacing would make the same one, so number the later ones, e.g.
+    # high_street_nw4_2. taken: set of url names already used (else the database is asked)
+    # base_url_name: Street.make_url_name of the name and postcode, if already worked out
+    def make_unique_url_name(self, name, partial_postcode, taken=None, base_url_name=None):
+        if base_url_name is None:
+            base_url_name = Street.make_url_name(name, partial_postcode)
+        url_name = base_url_name
+        n = 1
+        while (url_name in taken) if taken is not None else self.filter(url_name=url_name).exists():
+            n += 1
+            suffix = '_%d' % n
+            url_name = base_url_name[:Street.URL_NAME_LENGTH - len(suffix)] + suffix
+        return url_name
+
+PARTIAL_POSTCODE_PARSE_RE = re.compile("[A-Z]+[0-9]+$")
+
 class Street(models.Model):
+    URL_NAME_LENGTH = 50
+
     name = models.CharField(max_length=200)
-    url_name = models.SlugField(max_length=50)
+    url_name = models.SlugField(max_length=URL_NAME_LENGTH, unique=True)
     partial_postcode = models.CharField(max_length=5) # e.g. NW4
 
     class Meta:
@@ -105,30 +156,9 @@ class Street(models.Model):
         
     # returns fairly specific report message (which makes this a bit fiddlier than necessary)
     # This is the routine used by data import, so it's very useful to be clear how the data change has affected collections
+    # (see BinCollectionManager.add_collections, for doing lots of these at once)
     def add_collection(self, collection_type, collection_day):
-        msg = ""
-        deleted_days = []
-        collection_day_name = BinCollection.number_to_day_name(collection_day)
-        if not settings.BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK:
-            # delete all other collections (of this type), on all days, then create a new one
-            for bc in self.bin_collections.filter(collection_type=collection_type).order_by('collection_day'):
-                if bc.collection_day != collection_day:
-                    deleted_days.append(BinCollection.number_to_day_name(bc.collection_day))
-                    bc.delete()
-        bin_collection, was_created = BinCollection.objects.get_or_create(street=self, collection_type=collection_type, collection_day=collection_day )
-        if was_created:
-            if deleted_days: # only if multiple collections are forbidden
-                if len(deleted_days)==1:
-                    msg = "changed collection from %s to %s" % (deleted_days[0], collection_day_name) # day changed
-                else:
-                    msg = "repaced %s collections with one on %s" % (' and '.join(deleted_days), collection_day_name)
-            else:
-                msg = "added %s collection" % collection_day_name
-        else:
-            bin_collection.last_update = datetime.datetime.now() # mark the data as modified, since it's up-to-date as of now
-            msg = "collection on %s remains unchanged" % collection_day_name
-        bin_collection.save()
-        return msg
+        return BinCollection.objects.add_collections([(self, collection_type, collection_day)])[0]
 
     objects = StreetManager()
 
@@ -141,7 +171,7 @@ class Street(models.Model):
     # Check it is a partial postcode, e.g. EN4
     @staticmethod
     def partial_postcode_parse(partial_postcode):
-        if re.match("[A-Z]+[0-9]+$", partial_postcode):
+        if PARTIAL_POSTCODE_PARSE_RE.match(partial_postcode):
             return partial_postcode
         return None
 
@@ -150,13 +180,76 @@ class Street(models.Model):
         url_name = '_'.join(street_name.strip().split())
         if partial_postcode:
             url_name += '_' + partial_postcode.strip()
-        return url_name.lower()
+        return url_name.lower()[:Street.URL_NAME_LENGTH]
         
         
+# Works out what adding a collection does to a street's collections: a list of
+# [id (None until written), collection type id, day], which is changed to suit.
+# Ids of collections which go are appended to deleted_ids, and of the one which
+# remains unchanged (if so) to unchanged_ids.
+# returns report message (as Street.add_collection), bool the day changed
+def plan_collection_change(collections, collection_type_id, collection_day, deleted_ids, unchanged_ids):
+    deleted_days = []
+    collection_day_name = BinCollection.number_to_day_name(collection_day)
+    if not settings.BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK:
+        # all other collections (of this type), on all days, go
+        same_type = [c for c in collections if c[1] == collection_type_id]
+        same_type.sort(key=lambda c: c[2])
+        for collection in same_type:
+            if collection[2] != collection_day:
+                deleted_days.append(BinCollection.number_to_day_name(collection[2]))
+                collections.remove(collection)
+                if collection[0] is not None:
+                    deleted_ids.append(collection[0])
+    existing = [c for c in collections if c[1] == collection_type_id and c[2] == collection_day]
+    if existing:
+        if existing[0][0] is not None:
+            unchanged_ids.append(existing[0][0])
+        return ("collection on %s remains unchanged" % collection_day_name, False)
+    collections.append([None, collection_type_id, collection_day])
+    if deleted_days: # only if multiple collections are forbidden
+        if len(deleted_days)==1:
+            return ("changed collection from %s to %s" % (deleted_days[0], collection_day_name), True) # day changed
+        return ("repaced %s collections with one on %s" % (' and '.join(deleted_days), collection_day_name), True)
+    return ("added %s collection" % collection_day_name, False)
+
 class BinCollectionManager(models.Manager):
     def find_by_street_name(self, street_name):
         return self.filter(street__name__icontains=street_name)                    
 
+    # Adds lots of collections at once: assignments is a list of (street,
+    # collection type, day), each done as Street.add_collection would, in order.
+    # Rather than queries for each, it's a query to load the streets' existing
+    # collections, then a batched delete of those which go and a batched upsert
+    # of those which are new (or unchanged, to mark them as up to date).
+    # returns list of report messages, one for each assignment
+    def add_collections(self, assignments, batch_size=500):
+        collections_by_street_id = {}
+        street_ids = list(set(street.id for street, collection_type, collection_day in assignments))
+        for street_id in street_ids:
+            collections_by_street_id[street_id] = []
+        for i in range(0, len(street_ids), batch_size):
+            for collection_id, street_id, collection_type_id, collection_day in self.filter(street__in=street_ids[i:i + batch_size]).values_list('id', 'street', 'collection_type', 'collection_day'):
+                collections_by_street_id[street_id].append([collection_id, collection_type_id, collection_day])
+
+        messages = []
+        deleted_ids = []
+        unchanged_ids = []
+        for street, collection_type, collection_day in assignments:
+            messages.append(plan_collection_change(collections_by_street_id[street.id], collection_type.id, collection_day, deleted_ids, unchanged_ids)[0])
+
+        now = datetime.datetime.now()
+        for i in range(0, len(deleted_ids), batch_size):
+            self.filter(id__in=deleted_ids[i:i + batch_size]).delete()
+        unchanged_ids = set(unchanged_ids)
+        upsert_rows(BinCollection, ('street', 'collection_type', 'collection_day', 'last_updated'),
+                ((street_id, collection_type_id, collection_day, now)
+                    for street_id, collections in collections_by_street_id.items()
+                    for collection_id, collection_type_id, collection_day in collections
+                    if collection_id is None or collection_id in unchanged_ids),
+                ('street', 'collection_type', 'collection_day'), ('last_updated',), batch_size)
+        return messages
+
 
 # Represents when a type of bin is collected for a particular street.
 class BinCollection(models.Model):
@@ -170,6 +263,7 @@ class BinCollection(models.Model):
 
     class Meta:
         ordering = ["street__name", "collection_day", "collection_type__friendly_id"]
+        unique_together = (('street', 'collection_type', 'collection_day'),)
         
     def get_collection_day_name(self):
         return self.number_to_day_name(self.collection_day)
@@ -183,10 +277,7 @@ class BinCollection(models.Model):
     # Convert from day of week string e.g. Sunday, to number, e.g. 0
     @staticmethod
     def day_of_week_string_to_number(day_of_week):
-        for row in DAY_OF_WEEK_CHOICES:
-            if row[1] == day_of_week:
-                return row[0]
-        return None
+        return DAY_NUMBERS_BY_NAME.get(day_of_week)
 
     # Convert from number to day of week string e.g. 0 to Sunday 
     # note: using mod 7 here, although perhaps any number > len(DAY_OF_WEEK_CHOICES) should throw an exception?
@@ -198,39 +289,167 @@ class BinCollection(models.Model):
 # Email alerts for bin collections
 
 class CollectionAlertManager(models.Manager):
-    def send_pending_alerts(self, now = None):
+    # confirmed alerts which haven't been looked at yet today (only those due by the given
+    # slot, those in the lease's shard, and those with ids after after_id, if given)
+    def get_unchecked_alerts(self, today, lease=None, after_id=None, slot=None):
+        unchecked_alerts = self.filter(confirmed__confirmed=True).filter(last_checked_date__lt=today)
+        if slot is not None:
+            unchecked_alerts = unchecked_alerts.filter(alert_slot__lte=slot)
+        if lease:
+            unchecked_alerts = lease.filter_alerts(unchecked_alerts)
+        if after_id:
+            unchecked_alerts = unchecked_alerts.filter(id__gt=after_id)
+        return unchecked_alerts
+
+    # Returns a list of (street, bin collections, alerts), one entry per street which has
+    # unchecked alerts, where the collections are those on the given day (may be empty).
+    # Uses a fixed number of queries however many subscribers there are: the alerts (with
+    # their streets), the collections on that day for all those streets, and the confirmations
+    # (so the unsubscribe URLs don't need a query each). The confirmation is cached on each
+    # alert as email_confirmation.
+    def get_unchecked_alerts_by_street(self, today, day_of_week, lease=None, after_id=None, slot=None):
+        unchecked_alerts = self.get_unchecked_alerts(today, lease, after_id, slot)
+        alerts = unchecked_alerts.select_related('street').order_by('street', 'id')
+
+        collections_by_street = {}
+        collections = BinCollection.objects.filter(collection_day=day_of_week,
+                street__in=unchecked_alerts.values('street')).select_related('collection_type').order_by('street', 'collection_type__friendly_id')
+        for bc in collections:
+            collections_by_street.setdefault(bc.street_id, []).append(bc)
+
+        confirmations = EmailConfirmation.objects.filter(
+                content_type=ContentType.objects.get_for_model(CollectionAlert),
+                object_id__in=unchecked_alerts.values('id'))
+        confirmations_by_alert = dict((ec.object_id, ec) for ec in confirmations)
+
+        alerts_by_street = []
+        for collection_alert in alerts:
+            collection_alert.email_confirmation = confirmations_by_alert.get(collection_alert.id)
+            if not alerts_by_street or alerts_by_street[-1][0] != collection_alert.street:
+                alerts_by_street.append((collection_alert.street, collections_by_street.get(collection_alert.street_id, []), []))
+            alerts_by_street[-1][2].append(collection_alert)
+        return alerts_by_street
+
+    # returns the day after today as (day of week in same format as DAY_OF_WEEK_CHOICES, day name)
+    @staticmethod
+    def get_tomorrow(today):
+        today_day_of_week = today.isoweekday()
+        assert today_day_of_week >= 1 and today_day_of_week <= 7
+        tomorrow_day_of_week = (today_day_of_week + 1) % 7
+        return tomorrow_day_of_week, BinCollection.number_to_day_name(tomorrow_day_of_week)
+
+    # returns the latest alert slot (hour) to have started by now, or None if it's before the first
+    @staticmethod
+    def get_slot(now):
+        started = [slot for slot, slot_name in ALERT_SLOT_CHOICES if slot <= now.hour]
+        if not started:
+            return None
+        return max(started)
+
+    # returns the number of alerts still to be sent today by the given slot
+    def count_alerts_due(self, today, slot):
+        tomorrow_day_of_week, tomorrow_day_name = self.get_tomorrow(today)
+        return self.get_unchecked_alerts(today, slot=slot).filter(
+                street__bin_collections__collection_day=tomorrow_day_of_week).distinct().count()
+
+    # Sends the alerts due by the given slot (by default, the latest slot to have
+    # started by now; alerts from earlier slots which are still unsent go too).
+    # workers is the number of threads rendering and sending emails at once; if
+    # pacer (an AlertPacer) is given, it's used to spread the sending out. If
+    # timer (an AlertRunTimer) is given, the time each phase takes is added to it.
+    def send_pending_alerts(self, now = None, workers = 1, slot = None, pacer = None, timer = None):
         if now == None:
             now = datetime.datetime.now()
         today = now.date()
         # print "doing day", today
+        if slot is None:
+            slot = self.get_slot(now)
+            if slot is None:
+                return # too early: nothing is due yet today
 
-        # find day of week in same format as DAY_OF_WEEK_CHOICES
-        today_day_of_week = today.isoweekday()
-        assert today_day_of_week >= 1 and today_day_of_week <= 7
-        tomorrow_day_of_week = (today_day_of_week + 1) % 7
-        tomorrow_day_name = BinCollection.number_to_day_name(tomorrow_day_of_week)
-        
-        for collection_alert in CollectionAlert.objects.filter(confirmed__confirmed=True).filter(last_checked_date__lt=today):
-            collections = collection_alert.street.bin_collections.filter(collection_day__exact=tomorrow_day_of_week)
+        tomorrow_day_of_week, tomorrow_day_name = self.get_tomorrow(today)
+        render_cache = AlertRenderCache(Site.objects.get_current().domain)
+        mailer = get_alert_mailer(workers, timer)
+
+        # Several runs (e.g. on different hosts) can go at once: each works through
+        # whichever shards of the alerts it manages to lease
+        holder = AlertShardLease.make_holder_name()
+        for lease in AlertShardLease.objects.claim_leases(today, slot, holder):
+            n_failed = self._send_alerts_in_shard(lease, today, tomorrow_day_of_week, tomorrow_day_name, render_cache, mailer, pacer, timer)
+            lease.release(completed=(n_failed == 0))
+
+    # Sends the alerts in order of id, checkpointing the highest id done on the
+    # lease after each batch, so if this run dies the next one to claim the
+    # lease carries on from there rather than starting again.
+    # Returns the number of alerts which couldn't be sent.
+    def _send_alerts_in_shard(self, lease, today, tomorrow_day_of_week, tomorrow_day_name, render_cache, mailer, pacer=None, timer=None):
+        after_id = lease.last_alert_id
+        if lease.n_failed:
+            # some alerts the shard's runs have tried so far couldn't be sent, maybe
+            # ones before the checkpoint: go through it all again, to retry them
+            # (the rest are checked by then, so are skipped)
+            after_id = 0
+        alerts_to_send = []
+        alerts_by_street = timed(timer, 'select', self.get_unchecked_alerts_by_street, today, tomorrow_day_of_week, lease, after_id, lease.slot)
+        for street, collections, collection_alerts in alerts_by_street:
             if collections:
-                bin_collection_types_subject = " + ".join(bc.get_collection_type_display() for bc in collections)
-                bin_collection_types_list = "\n".join("  * %s\n" % bc.get_collection_type_display() for bc in collections)
-                send_email('Bin collection tomorrow, %s! (%s)' % (tomorrow_day_name, bin_collection_types_subject),
-                           'email-alert.txt', 
-                           Context({
-                            'bin_collection_types_list': bin_collection_types_list,
-                            'street_name': collection_alert.street.__unicode__(),
-                            'tomorrow_day_name': tomorrow_day_name,
-                            'collection_alert': collection_alert,
-                            'domain': Site.objects.get_current().domain,
-                            }, 
-                                   ), 
-                           collection_alert.email,
-                )
-                collection_alert.last_sent_date = today
-                
-            collection_alert.last_checked_date = today
-            collection_alert.save()
+                alerts_to_send.extend((street, collections, collection_alert) for collection_alert in collection_alerts)
+        alerts_to_send.sort(key=lambda alert_to_send: alert_to_send[2].id)
+
+        # alerts with nothing collected tomorrow are done with, in one go
+        timed(timer, 'bookkeeping', self._check_alerts_with_nothing_due, lease, today, tomorrow_day_of_week, after_id)
+
+        n_failed = 0
+        messages = self._make_alert_messages(alerts_to_send, tomorrow_day_name, render_cache)
+        for batch in mailer.send_batches(messages):
+            n_failed_in_batch, still_leased = timed(timer, 'bookkeeping', self._record_batch, lease, today, batch)
+            n_failed += n_failed_in_batch
+            if not still_leased:
+                # the lease ran out and someone else has the shard now: leave the rest to them
+                sys.stderr.write("lost lease on alert shard %s, stopping\n" % lease.shard)
+                n_failed += 1
+                break
+            # hold the lease while waiting for the next batch's turn
+            if pacer and not pacer.wait(len(batch), keep_alive=lease.checkpoint):
+                sys.stderr.write("lost lease on alert shard %s while waiting, stopping\n" % lease.shard)
+                n_failed += 1
+                break
+        return n_failed
+
+    def _check_alerts_with_nothing_due(self, lease, today, tomorrow_day_of_week, after_id):
+        n_checked = self.get_unchecked_alerts(today, lease, after_id, lease.slot).exclude(street__bin_collections__collection_day=tomorrow_day_of_week).update(last_checked_date=today)
+        lease.checkpoint(n_checked=n_checked)
+
+    # Marks the alerts in a batch sent by the mailer as sent, and checkpoints the
+    # lease. Returns (number which couldn't be sent, whether the lease is still held).
+    def _record_batch(self, lease, today, batch):
+        sent_ids = []
+        refused_ids = []
+        n_failed = 0
+        for collection_alert, error in batch:
+            if is_permanent_failure(error):
+                # it will never get through: checked, so it isn't tried again today
+                sys.stderr.write("gave up on alert to %s: %s\n" % (collection_alert.email, error))
+                refused_ids.append(collection_alert.id)
+            elif error:
+                # leave it unchecked, so the next run tries again
+                sys.stderr.write("failed to send alert to %s: %s\n" % (collection_alert.email, error))
+                n_failed += 1
+            else:
+                sent_ids.append(collection_alert.id)
+        if sent_ids:
+            self.filter(id__in=sent_ids).update(last_checked_date=today, last_sent_date=today)
+        if refused_ids:
+            self.filter(id__in=refused_ids).update(last_checked_date=today)
+        # every alert up to the highest id in the batch has now been tried
+        last_alert_id = max(collection_alert.id for collection_alert, error in batch)
+        still_leased = lease.checkpoint(last_alert_id=last_alert_id, n_sent=len(sent_ids), n_failed=n_failed)
+        return n_failed, still_leased
+
+    # yields (alert, function making its email), so the mailer renders each one when it's needed
+    def _make_alert_messages(self, alerts_to_send, day_name, render_cache):
+        for street, collections, collection_alert in alerts_to_send:
+            yield collection_alert, functools.partial(render_cache.render_message, street, day_name, collections, collection_alert)
 
 class CollectionAlert(models.Model):
     email = models.EmailField()
@@ -239,6 +458,7 @@ class CollectionAlert(models.Model):
     confirmed = generic.GenericRelation(EmailConfirmation)
     last_checked_date = models.DateField(default=datetime.date(2000, 01, 01)) # always long in the past
     last_sent_date = models.DateField(default=None, blank=True, null=True) 
+    alert_slot = models.IntegerField(choices=ALERT_SLOT_CHOICES, default=DEFAULT_ALERT_SLOT) # hour it's sent at
     
     objects = CollectionAlertManager()
 
@@ -252,8 +472,10 @@ class CollectionAlert(models.Model):
         ret.update({'street_name': self.street.name, 'email': self.email})
         return ret
 
+    # send_pending_alerts caches the confirmation on the alert, to save a query per email
     def get_unsubscribe_url(self):
-        return self.confirmed.all()[0].path_for_unsubscribe()
+        email_confirmation = getattr(self, 'email_confirmation', None) or self.confirmed.all()[0]
+        return email_confirmation.path_for_unsubscribe()
 
     class Meta:
         ordering = ('email',)
@@ -261,6 +483,906 @@ class CollectionAlert(models.Model):
     def __unicode__(self):
         return 'Alert for %s, street %s, confirmed %s' % (self.email, self.street.url_name, self.is_confirmed())
 
+# Alerts are split into shards by street id, so that several runs of
+# send-alerts (e.g. on different hosts) can share the work without sending
+# anyone the same alert twice. For each day and alert slot there's one
+# AlertShardLease per shard: a run claims a shard by taking out a time-limited lease on it,
+# processes it, then releases it. If a run dies, its shard can be claimed by
+# another run once the lease has expired.
+class AlertShardLeaseManager(models.Manager):
+    # returns the leases for the given day and slot, creating them (splitting the streets
+    # into BINS_ALERT_SHARDS ranges of street ids) if this is the first run for that slot
+    def get_leases(self, run_date, slot):
+        leases = list(self.filter(run_date=run_date, slot=slot).order_by('shard'))
+        if not leases:
+            try:
+                leases = self._create_leases(run_date, slot)
+            except IntegrityError: # another run created them first
+                leases = list(self.filter(run_date=run_date, slot=slot).order_by('shard'))
+        return leases
+
+    @transaction.commit_on_success
+    def _create_leases(self, run_date, slot):
+        self.filter(run_date__lt=run_date - datetime.timedelta(days=7)).delete() # tidy up old ones
+        n_shards = max(1, settings.BINS_ALERT_SHARDS)
+        max_street_id = Street.objects.aggregate(models.Max('id'))['id__max'] or 0
+        shard_size = max_street_id / n_shards + 1
+        leases = []
+        for shard in range(n_shards):
+            street_id_to = None # last shard is open-ended, to catch any streets added during the day
+            if shard < n_shards - 1:
+                street_id_to = (shard + 1) * shard_size
+            leases.append(self.create(run_date=run_date, slot=slot, shard=shard, street_id_from=shard * shard_size, street_id_to=street_id_to))
+        return leases
+
+    # the leases for the day and slot whose shards haven't been completed yet:
+    # either someone holds them (see AlertShardLease.is_held) or they're waiting
+    # for a run to claim them
+    def get_incomplete_leases(self, run_date, slot):
+        return list(self.filter(run_date=run_date, slot=slot, completed=False).order_by('shard'))
+
+    # yields each lease for the day and slot which the holder manages to claim, in turn
+    def claim_leases(self, run_date, slot, holder):
+        for lease in self.get_leases(run_date, slot):
+            if lease.claim(holder):
+                yield lease
+
+class AlertShardLease(models.Model):
+    run_date = models.DateField()
+    slot = models.IntegerField(choices=ALERT_SLOT_CHOICES, default=DEFAULT_ALERT_SLOT)
+    shard = models.IntegerField()
+    street_id_from = models.IntegerField()
+    street_id_to = models.IntegerField(null=True, blank=True) # None means no upper limit
+    holder = models.CharField(max_length=100, blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+    # progress of the run(s) through the shard
+    claimed = models.DateTimeField(null=True, blank=True) # when the lease was last claimed
+    finished = models.DateTimeField(null=True, blank=True)
+    last_alert_id = models.IntegerField(default=0) # checkpoint: highest alert id processed
+    n_checked = models.IntegerField(default=0) # alerts with nothing to send
+    n_sent = models.IntegerField(default=0)
+    n_failed = models.IntegerField(default=0)
+
+    objects = AlertShardLeaseManager()
+
+    class Meta:
+        ordering = ('-run_date', 'slot', 'shard')
+        unique_together = (('run_date', 'slot', 'shard'),)
+
+    def __unicode__(self):
+        return 'Alert shard %s for %s, %s' % (self.shard, self.run_date, self.get_slot_display())
+
+    # unique to this run, but saying where it is to anyone looking at the leases
+    @staticmethod
+    def make_holder_name():
+        return '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    # only alerts for streets in this shard (alerts with no street go in the first shard)
+    def filter_alerts(self, alerts):
+        in_shard = models.Q(street__id__gte=self.street_id_from)
+        if self.street_id_to is not None:
+            in_shard &= models.Q(street__id__lt=self.street_id_to)
+        if self.shard == 0:
+            in_shard |= models.Q(street__isnull=True)
+        return alerts.filter(in_shard)
+
+    # Takes out the lease, if no one else has it. This is a single conditional
+    # UPDATE, so if several runs try at once only one of them gets it.
+    # Returns True if it was claimed.
+    def claim(self, holder):
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=settings.BINS_ALERT_LEASE_SECONDS)
+        claimed = AlertShardLease.objects.filter(id=self.id, completed=False).filter(
+                models.Q(expires__isnull=True) | models.Q(expires__lt=now)).update(holder=holder, expires=expires, claimed=now)
+        if claimed:
+            self.holder = holder
+            self.expires = expires
+            # where the last run to hold it got to
+            self.last_alert_id, self.n_failed = AlertShardLease.objects.filter(id=self.id).values_list('last_alert_id', 'n_failed')[0]
+        return claimed == 1
+
+    # whether a run (maybe one which has died) has the lease, so no one else can claim it yet
+    def is_held(self):
+        return not self.completed and self.expires is not None and self.expires >= datetime.datetime.now()
+
+    # Records progress (adding to the counts) and extends the lease. Returns
+    # False if the lease has been lost, i.e. it expired and someone else claimed it.
+    def checkpoint(self, last_alert_id=None, n_checked=0, n_sent=0, n_failed=0):
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=settings.BINS_ALERT_LEASE_SECONDS)
+        updates = dict(expires=expires,
+                n_checked=models.F('n_checked') + n_checked,
+                n_sent=models.F('n_sent') + n_sent,
+                n_failed=models.F('n_failed') + n_failed)
+        if last_alert_id is not None:
+            updates['last_alert_id'] = last_alert_id
+        renewed = AlertShardLease.objects.filter(id=self.id, holder=self.holder).update(**updates)
+        if renewed:
+            self.expires = expires
+            if last_alert_id is not None:
+                self.last_alert_id = last_alert_id
+        return renewed == 1
+
+    # Gives up the lease. If the shard wasn't completed (some emails couldn't be
+    # sent) another run can claim it straight away, and it starts from the
+    # beginning again, to retry those (the rest are checked by then, so are skipped).
+    def release(self, completed=True):
+        updates = dict(expires=None, completed=completed)
+        if completed:
+            updates['finished'] = datetime.datetime.now()
+        else:
+            updates['last_alert_id'] = 0
+        AlertShardLease.objects.filter(id=self.id, holder=self.holder).update(**updates)
+        self.expires = None
+        self.completed = completed
+
+    # describes how far the shard has got, for send-alerts --status
+    def get_status(self):
+        if self.completed:
+            state = "completed at %s" % self.finished.strftime('%H:%M:%S')
+        elif not self.holder:
+            state = "not started"
+        elif self.is_held():
+            state = "in progress (%s, lease until %s)" % (self.holder, self.expires.strftime('%H:%M:%S'))
+        else:
+            state = "stopped (%s), waiting to be carried on by the next run" % self.holder
+        return "%s shard %s: %s; up to alert id %s, %s sent, %s failed, %s with nothing to send" % (
+                self.get_slot_display(), self.shard, state, self.last_alert_id, self.n_sent, self.n_failed, self.n_checked)
+
+# Outbox of rendered alert emails. Instead of send_pending_alerts rendering
+# and sending in one go, alerts can go out in two stages: enqueue_alerts
+# (e.g. the evening before) renders the day's alerts into AlertMessages, then
+# drain_alerts sends them at the right time. A message that couldn't be sent
+# stays in the outbox for a later drain (it is never rendered again), until
+# it has failed BINS_ALERT_MAX_ATTEMPTS times or its recipient is refused.
+class AlertMessageManager(models.Manager):
+    # Renders the alerts due to be sent on send_date into the outbox, and marks
+    # all the alerts as checked for that day (so send_pending_alerts won't send
+    # them again). Returns the number of messages queued.
+    @transaction.commit_on_success
+    def enqueue_alerts(self, send_date):
+        tomorrow_day_of_week, tomorrow_day_name = CollectionAlert.objects.get_tomorrow(send_date)
+        render_cache = AlertRenderCache(Site.objects.get_current().domain)
+        alerts_by_street = CollectionAlert.objects.get_unchecked_alerts_by_street(send_date, tomorrow_day_of_week)
+        now = datetime.datetime.now()
+
+        def make_rows():
+            for street, collections, collection_alerts in alerts_by_street:
+                if collections:
+                    for collection_alert in collection_alerts:
+                        subject, body = render_cache.render(street, tomorrow_day_name, collections, collection_alert)
+                        yield (collection_alert.id, send_date, collection_alert.email, subject, body, now, 0, '', '')
+        n_messages = insert_rows(AlertMessage,
+                ('alert', 'send_date', 'email', 'subject', 'body', 'created', 'attempts', 'last_error', 'holder'),
+                make_rows())
+
+        alert_ids = [collection_alert.id for street, collections, collection_alerts in alerts_by_street for collection_alert in collection_alerts]
+        for i in range(0, len(alert_ids), settings.BINS_ALERT_BATCH_SIZE):
+            CollectionAlert.objects.filter(id__in=alert_ids[i:i + settings.BINS_ALERT_BATCH_SIZE]).update(last_checked_date=send_date)
+        return n_messages
+
+    # Sends the unsent messages in the outbox for send_date, streaming them from
+    # the database a batch at a time. Several drains can run at once: each
+    # claims a batch with a time-limited lease before sending it (as for
+    # AlertShardLease). If slot is given, only messages for alerts due by that
+    # slot are sent, and if pacer (an AlertPacer) is given it's used to spread
+    # the sending out. Returns (number sent, number which failed).
+    def drain_alerts(self, send_date, workers=1, slot=None, pacer=None):
+        holder = AlertShardLease.make_holder_name()
+        mailer = get_alert_mailer(workers)
+        failed_ids = [] # not tried again by this drain
+        n_sent = 0
+        while True:
+            message_ids = self._get_claimable(send_date, failed_ids, slot).order_by('id').values_list('id', flat=True)[:settings.BINS_ALERT_BATCH_SIZE]
+            message_ids = list(message_ids)
+            if not message_ids:
+                break
+            messages = self._claim(send_date, message_ids, holder, failed_ids, slot)
+            for batch in mailer.send_batches((message, message.make_email_message) for message in messages):
+                sent_messages = []
+                for message, error in batch:
+                    if error:
+                        failed_ids.append(message.id)
+                        attempts = message.attempts + 1
+                        if is_permanent_failure(error):
+                            attempts = max(attempts, settings.BINS_ALERT_MAX_ATTEMPTS)
+                        if attempts >= settings.BINS_ALERT_MAX_ATTEMPTS:
+                            sys.stderr.write("gave up on alert to %s: %s\n" % (message.email, error))
+                        else:
+                            sys.stderr.write("failed to send alert to %s: %s\n" % (message.email, error))
+                        self.filter(id=message.id).update(attempts=attempts, last_error=error, expires=None)
+                    else:
+                        sent_messages.append(message)
+                if sent_messages:
+                    self.filter(id__in=[m.id for m in sent_messages]).update(sent=datetime.datetime.now(), expires=None)
+                    CollectionAlert.objects.filter(id__in=[m.alert_id for m in sent_messages]).update(last_sent_date=send_date)
+                    n_sent += len(sent_messages)
+                if pacer:
+                    pacer.wait(len(batch))
+        return n_sent, len(failed_ids)
+
+    # returns the number of messages for the day still to be sent by the given slot
+    def count_alerts_due(self, send_date, slot):
+        return self._get_claimable(send_date, [], slot).count()
+
+    # returns the number of messages for the day due by the given slot which
+    # haven't been sent, including any leased by a drain still going (or which
+    # died), but not those given up on
+    def count_alerts_unsent(self, send_date, slot):
+        return self._get_unsent(send_date).filter(alert__alert_slot__lte=slot).count()
+
+    # unsent messages for the day which haven't been given up on (see BINS_ALERT_MAX_ATTEMPTS)
+    def _get_unsent(self, send_date):
+        return self.filter(send_date=send_date, sent__isnull=True, attempts__lt=settings.BINS_ALERT_MAX_ATTEMPTS)
+
+    # unsent messages for the day (due by the slot, if given) which no one else has a lease on
+    def _get_claimable(self, send_date, exclude_ids, slot=None):
+        claimable = self._get_unsent(send_date).filter(
+                models.Q(expires__isnull=True) | models.Q(expires__lt=datetime.datetime.now()))
+        if slot is not None:
+            claimable = claimable.filter(alert__alert_slot__lte=slot)
+        if exclude_ids:
+            claimable = claimable.exclude(id__in=exclude_ids)
+        return claimable
+
+    # leases whichever of the messages are still claimable, returns the ones this holder got
+    def _claim(self, send_date, message_ids, holder, exclude_ids, slot=None):
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=settings.BINS_ALERT_LEASE_SECONDS)
+        self._get_claimable(send_date, exclude_ids, slot).filter(id__in=message_ids).update(holder=holder, expires=expires)
+        return list(self.filter(id__in=message_ids, holder=holder, sent__isnull=True).order_by('id'))
+
+class AlertMessage(models.Model):
+    alert = models.ForeignKey(CollectionAlert, related_name='messages')
+    send_date = models.DateField()
+    email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    created = models.DateTimeField()
+    sent = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0) # failed attempts to send it (given up on at BINS_ALERT_MAX_ATTEMPTS)
+    last_error = models.TextField(blank=True)
+    holder = models.CharField(max_length=100, blank=True) # drain which has a lease on it...
+    expires = models.DateTimeField(null=True, blank=True) # ...and when that lease runs out
+
+    objects = AlertMessageManager()
+
+    class Meta:
+        ordering = ('-send_date', 'email')
+        unique_together = (('alert', 'send_date'),)
+
+    def __unicode__(self):
+        return 'Alert email to %s for %s' % (self.email, self.send_date)
+
+    def make_email_message(self):
+        return EmailMessage(self.subject, self.body, settings.DEFAULT_FROM_EMAIL, [self.email])
+
+#######################################################################################
+# Data import
+
+# The partial postcodes of the streets with each name (ignoring case), for
+# guessing the postcodes of imported streets which haven't got one, and for
+# the error messages when a guess can't be made. It's built once per import,
+# with one query (or from streets already loaded), and kept up to date as the
+# import makes streets, so guessing a postcode needs no queries.
+class StreetPostcodeIndex(object):
+    # streets: (name, partial postcode) pairs; if not given, all the streets in the database
+    def __init__(self, streets=None):
+        self.postcodes_by_name = {}
+        if streets is None:
+            streets = Street.objects.values_list('name', 'partial_postcode')
+        for name, partial_postcode in streets:
+            self.add(name, partial_postcode)
+
+    def add(self, name, partial_postcode):
+        if partial_postcode:
+            self.postcodes_by_name.setdefault(name.upper(), set()).add(partial_postcode)
+
+    # as StreetManager.get_postcodes_for_name
+    def get_postcodes(self, name):
+        return sorted(self.postcodes_by_name.get(name.upper(), ()))
+
+# Where an import finds and makes streets and collections. This one goes
+# straight to the database: several queries for each street looked up, and
+# a get_or_create and a save for each collection.
+class ImportStore(object):
+    def __init__(self):
+        self.postcode_index = None # made when first needed
+        self.collection_types = None # likewise
+
+    # the collection type with the friendly id, or default if none does (or friendly_id is None)
+    def get_collection_type(self, friendly_id, default=None):
+        if self.collection_types is None:
+            self.collection_types = dict((t.friendly_id, t) for t in BinCollectionType.objects.all())
+        return self.collection_types.get(friendly_id, default)
+
+    # returns street, bool was created, bool guessed_postcode (as StreetManager.get_or_create_street)
+    def get_or_create_street(self, name, partial_postcode=None, guess_postcodes=False):
+        if not partial_postcode and self.postcode_index is None:
+            self.postcode_index = StreetPostcodeIndex()
+        return Street.objects.get_or_create_street(name, partial_postcode, guess_postcodes=guess_postcodes, postcode_index=self.postcode_index)
+
+    # returns report message (as Street.add_collection)
+    def add_collection(self, street, collection_type, collection_day):
+        return street.add_collection(collection_type, collection_day)
+
+    # writes anything not yet written to the database
+    def flush(self):
+        pass
+
+# Does the same as ImportStore, but in memory: all the streets and collections
+# are loaded up front, indexed by (case-insensitive) street name, and the
+# changes are worked out against that. flush then writes them all in one
+# transaction, with batched inserts and updates, so a big import is a handful
+# of queries rather than tens of thousands, and either all goes in or none of it.
+# The streets and report messages are exactly as ImportStore would give.
+# Use a new store for each import: flush is only meant to be called once.
+class BulkImportStore(ImportStore):
+    batch_size = 500 # rows per batched insert, and ids per batched update or delete
+    url_name_attempts = 3 # times write_new_streets tries again with fresh url names
+
+    def __init__(self, batch_size=None):
+        if batch_size:
+            self.batch_size = batch_size
+        self.collection_types = None
+        self.streets_by_name = {}
+        self.url_names = set()
+        self.postcode_index = StreetPostcodeIndex([])
+        self.normalise = ImportNormaliser() # for the url names of new streets
+        streets_by_id = {}
+        for street in Street.objects.all():
+            self._add_street(street)
+            streets_by_id[street.id] = street
+        for collection_id, street_id, collection_type_id, collection_day in BinCollection.objects.values_list('id', 'street', 'collection_type', 'collection_day'):
+            streets_by_id[street_id].import_collections.append([collection_id, collection_type_id, collection_day])
+        self.new_streets = []
+        self.deleted_collection_ids = []
+        self.updated_collection_ids = []
+        self.n_day_changes = 0
+        self.ambiguous_names = []
+
+    def _add_street(self, street):
+        street.import_collections = [] # [id (None until written), collection type id, day]
+        streets = self.streets_by_name.setdefault(street.name.upper(), [])
+        streets.append(street)
+        self.url_names.add(street.url_name)
+        self.postcode_index.add(street.name, street.partial_postcode)
+        streets.sort(key=lambda street: (street.name, street.partial_postcode)) # as Street's ordering
+
+    # as StreetManager.get_or_create_street, which see
+    def get_or_create_street(self, name, partial_postcode=None, guess_postcodes=False):
+        if not partial_postcode:
+            partial_postcode = ''
+        if not name:
+            raise IntegrityError('street has no name')
+        did_guess_postcode = False
+        candidate_streets = self.streets_by_name.get(name.upper(), [])
+        if not partial_postcode:
+            postcodes = self.postcode_index.get_postcodes(name)
+            if len(postcodes) == 1 and guess_postcodes:
+                partial_postcode = postcodes[0]
+                did_guess_postcode = True
+            elif settings.BINS_STREETS_MUST_HAVE_POSTCODE:
+                msg = '"%s" has no postcode' % name
+                if postcodes:
+                    msg += ' (my guess from existing data is: %s)' % ' or '.join(postcodes)
+                raise IntegrityError(msg)
+        matches = [street for street in candidate_streets if street.partial_postcode == partial_postcode]
+        if len(matches) == 1:
+            return (matches[0], False, did_guess_postcode)
+        if len(matches) > 1:
+            self.ambiguous_names.append(name)
+            msg = '"%s" with postcode "%s" found multiple matches, should only be one' % (name, partial_postcode)
+            raise IntegrityError(msg)
+        if len(candidate_streets) > 1:
+            self.ambiguous_names.append(name)
+            msg = '"%s" is ambiguous, %s possibilities: %s' % (name, len(candidate_streets), " or ".join('"' + s.__unicode__() + '"' for s in candidate_streets))
+            raise IntegrityError(msg)
+        url_name = Street.objects.make_unique_url_name(name, partial_postcode, taken=self.url_names,
+                base_url_name=self.normalise.url_name(name, partial_postcode))
+        street = Street(name=name, url_name=url_name, partial_postcode=partial_postcode)
+        self._add_street(street)
+        self.new_streets.append(street)
+        return (street, True, did_guess_postcode)
+
+    # as Street.add_collection, which see
+    def add_collection(self, street, collection_type, collection_day):
+        msg, day_changed = plan_collection_change(street.import_collections, collection_type and collection_type.id, collection_day,
+                self.deleted_collection_ids, self.updated_collection_ids)
+        if day_changed:
+            self.n_day_changes += 1
+        return msg
+
+    # the change plan: a summary of what flush would write (for a dry run)
+    def describe_changes(self):
+        n_new_collections = len([collection for streets in self.streets_by_name.values() for street in streets
+                for collection in street.import_collections if collection[0] is None])
+        lines = [
+            "planned new streets: %s" % len(self.new_streets),
+            "planned new collections: %s" % n_new_collections,
+            "planned day changes: %s" % self.n_day_changes,
+            "planned collections removed: %s" % len(self.deleted_collection_ids),
+            "collections unchanged: %s" % len(self.updated_collection_ids),
+        ]
+        if self.ambiguous_names:
+            names = sorted(set(self.ambiguous_names))
+            lines.append("ambiguous street names (not imported): %s: %s" % (len(names), ", ".join(names)))
+        return lines
+
+    # writes the changes in one transaction
+    @transaction.commit_on_success
+    def flush(self):
+        self.write()
+
+    # as flush, but in the caller's transaction
+    # Streets and collections are written with upserts (see bulk.upsert_rows) on
+    # their unique keys, so a row another import has written in the meantime is
+    # picked up rather than duplicated (or failing the whole import).
+    def write(self):
+        now = datetime.datetime.now()
+        batch_size = self.batch_size
+        for i in range(0, len(self.deleted_collection_ids), batch_size):
+            BinCollection.objects.filter(id__in=self.deleted_collection_ids[i:i + batch_size]).delete()
+
+        if self.new_streets:
+            self.write_new_streets()
+
+        # new collections are inserted, and unchanged ones touched (last_updated), in the same upserts
+        upsert_rows(BinCollection, ('street', 'collection_type', 'collection_day', 'last_updated'), self.collection_rows(now),
+                ('street', 'collection_type', 'collection_day'), ('last_updated',), batch_size)
+
+    # Upserts the new streets and picks up their ids afterwards (which
+    # upsert_rows doesn't return) by their url names. A url name another import
+    # has given to the same street in the meantime just means using that row,
+    # but if it has given it to a different street, the new street gets a fresh
+    # url name and is written again, rather than having its collections put on
+    # the other street.
+    def write_new_streets(self):
+        batch_size = self.batch_size
+        streets = self.new_streets
+        for attempt in range(self.url_name_attempts):
+            upsert_rows(Street, ('name', 'url_name', 'partial_postcode'),
+                    ((street.name, street.url_name, street.partial_postcode) for street in streets),
+                    ('url_name',), (), batch_size)
+            written = {}
+            for i in range(0, len(streets), batch_size):
+                for street_id, name, url_name, partial_postcode in Street.objects.filter(
+                        url_name__in=[street.url_name for street in streets[i:i + batch_size]]).values_list('id', 'name', 'url_name', 'partial_postcode'):
+                    written[url_name] = (street_id, name, partial_postcode)
+            clashes = []
+            for street in streets:
+                street_id, name, partial_postcode = written[street.url_name]
+                if (name.upper(), partial_postcode) == (street.name.upper(), street.partial_postcode):
+                    street.id = street_id
+                else:
+                    clashes.append(street)
+            if not clashes:
+                return
+            for street in clashes:
+                street.url_name = self.make_fresh_url_name(street)
+            streets = clashes
+        raise IntegrityError('url names of new streets keep being taken by other imports: %s' %
+                ", ".join('"%s"' % street.url_name for street in streets))
+
+    # a url name for street which is taken neither here nor in the database
+    def make_fresh_url_name(self, street):
+        base_url_name = self.normalise.url_name(street.name, street.partial_postcode)
+        while True:
+            url_name = Street.objects.make_unique_url_name(street.name, street.partial_postcode, taken=self.url_names,
+                    base_url_name=base_url_name)
+            self.url_names.add(url_name)
+            if not Street.objects.filter(url_name=url_name).exists():
+                return url_name
+
+    # (street id, collection type id, day, now) for each collection which is new or unchanged
+    def collection_rows(self, now):
+        updated_collection_ids = set(self.updated_collection_ids)
+        for streets in self.streets_by_name.values():
+            for street in streets:
+                for collection_id, collection_type_id, collection_day in street.import_collections:
+                    if collection_id is None or collection_id in updated_collection_ids:
+                        yield (street.id, collection_type_id, collection_day, now)
+
+# Does the same as BulkImportStore, but rather than changing the streets and
+# collections tables in place, write copies them (to binalerts_street_shadow
+# and so on), makes the changes to the copies, then swaps the copies in for the
+# real tables. Meanwhile the site reads the old tables as normal (writes to
+# them wait until the import is done, or they'd be lost in the swap), and the
+# swap holds the tables exclusively for only as long as a few renames and
+# foreign key changes take: the foreign keys are made again without checking
+# the rows, which validate_foreign_keys does once the swap is committed. If
+# anything goes wrong before then, the copies are just rolled back with the
+# transaction. Only works with PostgreSQL.
+class ShadowImportStore(BulkImportStore):
+    shadowed_models = (Street, BinCollection)
+
+    def __init__(self, batch_size=None):
+        super(ShadowImportStore, self).__init__(batch_size)
+        self.unvalidated_foreign_keys = [] # (table, constraint name) made by the swap
+
+    # as BulkImportStore.write, which see (all in the caller's transaction)
+    def write(self):
+        if 'postgresql' not in connection.settings_dict['ENGINE']:
+            raise Exception("shadow imports need PostgreSQL")
+        now = datetime.datetime.now()
+        batch_size = self.batch_size
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        tables = [model._meta.db_table for model in self.shadowed_models]
+        shadow_tables = dict((table, table + '_shadow') for table in tables)
+        for table in tables:
+            cursor.execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' % qn(table)) # reading (and foreign key checks) still allowed
+        for table in tables:
+            # the copy has the same columns, defaults (so ids come from the same sequence), indexes and
+            # unique keys, but not the foreign keys, which are moved over in the swap
+            cursor.execute('DROP TABLE IF EXISTS %s' % qn(shadow_tables[table]))
+            cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING ALL)' % (qn(shadow_tables[table]), qn(table)))
+            cursor.execute('INSERT INTO %s SELECT * FROM %s' % (qn(shadow_tables[table]), qn(table)))
+
+        collection_table = qn(shadow_tables[BinCollection._meta.db_table])
+        for i in range(0, len(self.deleted_collection_ids), batch_size):
+            ids = self.deleted_collection_ids[i:i + batch_size]
+            cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (collection_table, ', '.join(['%s'] * len(ids))), ids)
+        if self.new_streets:
+            # nothing else can be adding streets, so take their ids straight from the sequence
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                    [Street._meta.db_table, len(self.new_streets)])
+            for street, (street_id,) in zip(self.new_streets, cursor.fetchall()):
+                street.id = street_id
+            insert_rows(Street, ('id', 'name', 'url_name', 'partial_postcode'),
+                    ((street.id, street.name, street.url_name, street.partial_postcode) for street in self.new_streets),
+                    batch_size, shadow_tables[Street._meta.db_table])
+        upsert_rows(BinCollection, ('street', 'collection_type', 'collection_day', 'last_updated'), self.collection_rows(now),
+                ('street', 'collection_type', 'collection_day'), ('last_updated',), batch_size, shadow_tables[BinCollection._meta.db_table])
+
+        self.swap(cursor, tables, shadow_tables)
+
+    # Swaps the shadow tables in for the tables, and drops the old ones. Foreign
+    # keys to and from the tables (e.g. from alerts to streets) are dropped and
+    # made again by name, which then refers to the new table. They're made NOT
+    # VALID, as checking every row of the tables which refer to streets (such
+    # as the import events, which grow with every import) would hold up
+    # reading the tables for as long as that takes. The new tables'
+    # indexes are given the old ones' names, so they stay the same from import to import.
+    def swap(self, cursor, tables, shadow_tables):
+        qn = connection.ops.quote_name
+        cursor.execute("""SELECT conname, conrelid::regclass::text, pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE contype = 'f' AND (conrelid::regclass::text IN %s OR confrelid::regclass::text IN %s)""",
+                [tuple(tables), tuple(tables)])
+        foreign_keys = cursor.fetchall()
+        index_renames = []
+        for table in tables:
+            index_names = {}
+            cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s", [table])
+            for index_name, definition in cursor.fetchall():
+                index_names[self.index_key(definition)] = index_name
+            cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s", [shadow_tables[table]])
+            for index_name, definition in cursor.fetchall():
+                old_index_name = index_names.get(self.index_key(definition))
+                if old_index_name and old_index_name != index_name:
+                    index_renames.append((index_name, old_index_name))
+        for table in tables:
+            cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % qn(table))
+        for name, table, definition in foreign_keys:
+            cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (qn(table), qn(name)))
+        for table in tables:
+            cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(table), qn(table + '_old')))
+            cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(shadow_tables[table]), qn(table)))
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table + '_old'])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute('ALTER SEQUENCE %s OWNED BY %s.id' % (sequence, qn(table))) # else it's dropped with the old table
+        for name, table, definition in foreign_keys:
+            if not definition.endswith(' NOT VALID'): # else left unvalidated by an earlier import
+                definition += ' NOT VALID'
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (qn(table), qn(name), definition))
+            self.unvalidated_foreign_keys.append((table, name))
+        for table in tables:
+            cursor.execute('DROP TABLE %s' % qn(table + '_old'))
+        for index_name, old_index_name in index_renames:
+            cursor.execute('ALTER INDEX %s RENAME TO %s' % (qn(index_name), qn(old_index_name)))
+
+    # Checks the rows against the foreign keys made by the swap, each in its own
+    # transaction. Call it once the swap has been committed: it only stops
+    # changes to the tables while it goes, not reading them.
+    def validate_foreign_keys(self):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for table, name in self.unvalidated_foreign_keys:
+            cursor.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (qn(table), qn(name)))
+            transaction.commit_unless_managed()
+        self.unvalidated_foreign_keys = []
+
+    # what an index is on, whatever it and its table are called, e.g. (True, "btree (url_name)") for a unique one
+    @staticmethod
+    def index_key(definition):
+        return ('UNIQUE' in definition.split(' ON ', 1)[0], definition.split(' USING ', 1)[1])
+
+# A file (by name) which data has been imported from, with digests of its
+# contents and of each row which was imported from it, so that importing a new
+# version of the file can skip the rows which haven't changed (or the whole
+# file, if none have). The import options (collection type, guessing
+# postcodes) are included in the digests, as they change what a row means.
+class ImportSource(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    file_digest = models.CharField(max_length=40, blank=True) # sha1 of the options and the whole file
+    last_imported = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('name',)
+
+    def __unicode__(self):
+        return self.name
+
+class ImportRowDigest(models.Model):
+    source = models.ForeignKey(ImportSource, related_name='row_digests')
+    digest = models.CharField(max_length=40) # sha1 of the options and the row
+
+    class Meta:
+        unique_together = (('source', 'digest'),)
+
+# Keeps track of the rows of an import, against the digests from the last
+# import from the same source. Rows which failed to import aren't recorded,
+# so they are tried again next time.
+class ImportDigests(object):
+    def __init__(self, name, options):
+        try:
+            self.source = ImportSource.objects.get(name=name)
+            self.old_digests = set(self.source.row_digests.values_list('digest', flat=True))
+        except ImportSource.DoesNotExist:
+            self.source = ImportSource(name=name) # saved with the digests, so a dry run leaves no trace
+            self.old_digests = set()
+        self.options = repr(options)
+        self.new_digests = set()
+        self.file_digest = ''
+        self.content_digest = None # sha1 of just the file, e.g. for the cache of rows read from it
+
+    def make_digest(self, row):
+        return hashlib.sha1(repr((self.options, row))).hexdigest()
+
+    # returns digest of the options and the whole of file f (which is left at
+    # the start); the digest of just the file is worked out as it's read
+    def make_file_digest(self, f):
+        digest = hashlib.sha1(self.options)
+        content_digest = hashlib.sha1()
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+            content_digest.update(chunk)
+        f.seek(0)
+        self.content_digest = content_digest.hexdigest()
+        return digest.hexdigest()
+
+    # works out the digest of f, a file or the name of one, for is_unchanged_file and save
+    def digest_file(self, f):
+        if isinstance(f, basestring):
+            f = open(f, 'rb')
+            try:
+                self.file_digest = self.make_file_digest(f)
+            finally:
+                f.close()
+        else:
+            self.file_digest = self.make_file_digest(f)
+
+    # whether the file is the same as last time it was imported
+    def is_unchanged_file(self):
+        return self.source.file_digest == self.file_digest
+
+    # whether the row was imported from the same source last time (if so, it's kept for next time)
+    def is_unchanged_row(self, row):
+        digest = self.make_digest(row)
+        if digest in self.old_digests:
+            self.new_digests.add(digest)
+            return True
+        return False
+
+    # records that the row was imported
+    def row_done(self, row):
+        self.new_digests.add(self.make_digest(row))
+
+    # stores the digests for next time: only those of the rows in this import
+    @transaction.commit_on_success
+    def save(self):
+        self.write()
+
+    # as save, but in the caller's transaction
+    def write(self):
+        if self.source.id is None:
+            self.source.save()
+        stale_digests = list(self.old_digests - self.new_digests)
+        for i in range(0, len(stale_digests), 500):
+            self.source.row_digests.filter(digest__in=stale_digests[i:i + 500]).delete()
+        insert_rows(ImportRowDigest, ('source', 'digest'),
+                ((self.source.id, digest) for digest in self.new_digests - self.old_digests))
+        self.source.file_digest = self.file_digest
+        self.source.last_imported = datetime.datetime.now()
+        self.source.save()
+
+# One run of an import, with its counts. What happened on each line is in its
+# ImportEvents, which are kept after the file and the DataImport are gone.
+class ImportRun(models.Model):
+    description = models.CharField(max_length=255)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True) # still empty if the import failed
+    n_rows = models.IntegerField(default=0) # rows (or lines) read
+    n_skipped = models.IntegerField(default=0) # rows unchanged since the last import
+    n_collections = models.IntegerField(default=0)
+    n_new_streets = models.IntegerField(default=0)
+    n_warnings = models.IntegerField(default=0)
+    n_errors = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return 'Import run %s: %s' % (self.id, self.description)
+
+IMPORT_EVENT_SEVERITY_CHOICES = (
+    ('info', 'Info'),
+    ('warning', 'Warning'), # imported, but check it (e.g. the postcode was guessed)
+    ('error', 'Error'), # not imported
+)
+
+class ImportEvent(models.Model):
+    run = models.ForeignKey(ImportRun, related_name='events')
+    seq = models.IntegerField() # order of the events within the run
+    line = models.IntegerField(null=True, blank=True) # line (or row) of the file, if about one
+    severity = models.CharField(max_length=10, choices=IMPORT_EVENT_SEVERITY_CHOICES, default='info', db_index=True)
+    message = models.TextField()
+    street_id = models.IntegerField(null=True, blank=True) # not a ForeignKey, so the event outlives the street
+
+    class Meta:
+        ordering = ('run', 'seq')
+        unique_together = (('run', 'seq'),)
+
+    def __unicode__(self):
+        return self.message
+
+# The report of an import, as it goes. If there's an ImportRun, the messages
+# are stored as its ImportEvents, batch_size at a time with insert_rows, so
+# memory use stays flat however big the file is (events about streets made by
+# a BulkImportStore are written before the streets have ids, so just their
+# sequence numbers are kept, to fill the ids in when the log is closed).
+# Otherwise (or as well, if want_onscreen_log) they're built up in lines, for
+# showing to the user, or written to stderr when run from the command line.
+class ImportLog(object):
+    batch_size = 500
+
+    def __init__(self, want_onscreen_log=False, run=None):
+        self.want_onscreen_log = want_onscreen_log
+        self.run = run
+        self.lines = []
+        self.events = [] # (seq, line, severity, message, street) waiting to be written
+        self.new_street_seqs = [] # (seq, street) of events written before their street had an id
+        self.n_events = 0
+        self.n_warnings = 0
+        self.n_errors = 0
+
+    def add(self, msg, line=None, severity='info', street=None):
+        if self.want_onscreen_log:
+            self.lines.append(msg)
+        elif self.run is None:
+            sys.stderr.write(msg + "\n")
+        if severity == 'warning':
+            self.n_warnings += 1
+        elif severity == 'error':
+            self.n_errors += 1
+        if self.run is None:
+            return
+        self.n_events += 1
+        if street is not None and street.id is None:
+            # made by a BulkImportStore, so has no id until the store is flushed
+            self.new_street_seqs.append((self.n_events, street))
+        self.events.append((self.n_events, line, severity, msg, street))
+        if len(self.events) >= self.batch_size:
+            self._write_events()
+
+    def _write_events(self):
+        insert_rows(ImportEvent, ('run', 'seq', 'line', 'severity', 'message', 'street_id'),
+                ((self.run.id, seq, line, severity, msg, street and street.id) for seq, line, severity, msg, street in self.events))
+        self.events = []
+
+    # Writes the rest of the events and the counts to the run, returns the lines
+    # (if want_onscreen_log). Call it after the store has been flushed.
+    def close(self, n_rows=0, n_skipped=0, n_collections=0, n_new_streets=0):
+        if self.run is not None:
+            self._write_events()
+            update_rows(ImportEvent, ('street_id',), ('run', 'seq'),
+                    ((street.id, self.run.id, seq) for seq, street in self.new_street_seqs if street.id is not None),
+                    self.batch_size)
+            self.new_street_seqs = []
+            ImportRun.objects.filter(id=self.run.id).update(finished=datetime.datetime.now(),
+                    n_rows=n_rows, n_skipped=n_skipped, n_collections=n_collections, n_new_streets=n_new_streets,
+                    n_warnings=self.n_warnings, n_errors=self.n_errors)
+        return self.lines
+
+# What an import file says should be done, worked out from the file alone,
+# without touching the database, so that it can be done in another process
+# (see DataImport.load_from_files). rows yields (line, row, steps) for each row
+# of data, where row is the row as read (for ImportDigests) and each step is
+# either ('error', message) or ('street', name, partial postcode, collection
+# type friendly_id (None for the import's default), [days]).
+# DataImport._apply_plan carries them out.
+
+class ImportPlan(object):
+    def __init__(self, kind, filename):
+        self.kind = kind # 'CSV' or 'XML', which decides the wording of the report
+        self.filename = filename
+        self.rows = []
+        self.n_rows = 0 # rows read, so far
+        self.found_data = False # whether the file's title line was found (and what kind of data it is)
+        self.content_digest = None # sha1 of the file, if already worked out (see ImportDigests), before the rows are read
+
+# Tidies up the street names, postcodes and days read from an import file, for
+# the loaders. The same values come up again and again in a file, so the
+# results are memoised; the patterns are compiled once; and there's no
+# database work, as it's used while parsing (perhaps in another process).
+# timer: as load_from_files, for the time spent in the 'normalise' stage
+class ImportNormaliser(object):
+    full_postcode_re = re.compile(r'^([A-Z]+[0-9]+) *[0-9][A-Z]{2}.*')
+    partial_postcode_re = re.compile('^[A-Z]{1,2}[0-9]{1,2}[A-Z]?$')
+    has_text_re = re.compile('\w')
+    day_separator_re = re.compile('\W')
+
+    def __init__(self, timer=None):
+        self.partial_postcodes = {}
+        self.street_names = {}
+        self.days = {}
+        self.url_names = {}
+        if timer is not None:
+            for name in ('partial_postcode', 'street_name', 'day_numbers', 'url_name'):
+                setattr(self, name, functools.partial(timed, timer, 'normalise', getattr(self, name)))
+
+    # the partial postcode (e.g. NW4) of a full or partial one, however it's written:
+    # returns partial postcode (or '' if none), bool whether it's a valid one
+    # partial_only: only a partial postcode is valid (not a full one, or none)
+    def partial_postcode(self, postcode, partial_only=False):
+        key = (postcode, partial_only)
+        try:
+            return self.partial_postcodes[key]
+        except KeyError:
+            if partial_only:
+                partial_postcode = canonicalise_postcode(postcode)
+                result = (partial_postcode, bool(self.partial_postcode_re.match(partial_postcode)))
+            else:
+                partial_postcode = self.full_postcode_re.sub(r'\1', canonicalise_postcode(postcode))
+                result = (partial_postcode, not partial_postcode or bool(self.partial_postcode_re.match(partial_postcode)))
+            self.partial_postcodes[key] = result
+            return result
+
+    # the street name with its spacing tidied up, or None if it's blank
+    def street_name(self, name):
+        try:
+            return self.street_names[name]
+        except KeyError:
+            street_name = ' '.join(name.strip().split())
+            if not self.has_text_re.match(street_name):
+                street_name = None
+            self.street_names[name] = street_name
+            return street_name
+
+    # the day numbers of day names, e.g. "Monday/Thursday" gives [1, None] (if
+    # several days are allowed): None for a name which isn't a day
+    def day_numbers(self, day_names, several=False):
+        key = (day_names, several)
+        try:
+            return self.days[key]
+        except KeyError:
+            if several:
+                days = [DAY_NUMBERS_BY_NAME.get(day_name) for day_name in self.day_separator_re.split(day_names)]
+            else:
+                days = [DAY_NUMBERS_BY_NAME.get(day_names)]
+            self.days[key] = days
+            return days
+
+    # as Street.make_url_name
+    def url_name(self, street_name, partial_postcode):
+        key = (street_name, partial_postcode)
+        try:
+            return self.url_names[key]
+        except KeyError:
+            url_name = Street.make_url_name(street_name, partial_postcode)
+            self.url_names[key] = url_name
+            return url_name
+
 class DataImport(models.Model):
     upload_file = models.FileField(upload_to='uploads')
     timestamp = models.DateTimeField(auto_now=True, auto_now_add=True, null=True) # allow tracking of change data
@@ -275,7 +1397,12 @@ class DataImport(models.Model):
         filename = os.path.split(self.upload_file.name)[1]
         return '%s: %s (guess postcodes: %s, type: %s)' % (self.timestamp, filename, guessing_postcodes, collection_type)
     
-    def import_data(self):       
+    # bulk: see BulkImportStore; incremental: see ImportSource
+    # progress: see load_from_csv_file; keep: if True, the DataImport and its file are left
+    # alone (otherwise they're deleted once the import is done)
+    # run: an ImportRun to store the report in (see ImportLog); if not given, the report lines are returned
+    # dry_run: see load_from_csv_file (the DataImport is always kept)
+    def import_data(self, bulk=True, incremental=True, progress=None, keep=False, run=None, dry_run=False):
         if self.upload_file:
             if self.upload_file.name.endswith('.csv'):
                 csv_file = self.upload_file
@@ -283,16 +1410,27 @@ class DataImport(models.Model):
                                     csv_file, 
                                     collection_type=self.implicit_collection_type, 
                                     guess_postcodes=self.guess_postcodes,
-                                    want_onscreen_log=True)
+                                    want_onscreen_log=run is None,
+                                    bulk=bulk,
+                                    incremental=incremental,
+                                    progress=progress,
+                                    run=run,
+                                    dry_run=dry_run)
             else:
                 if self.upload_file.name.endswith('.xml'):
                     report_lines = DataImport.load_from_pdf_xml(
                                     self.upload_file.path, 
                                     collection_type=self.implicit_collection_type, 
                                     guess_postcodes=self.guess_postcodes,
-                                    want_onscreen_log=True)
-            self.upload_file.delete()
-            self.delete() # deleting everything after import seems harh, but also keeps the DataImport admin clean
+                                    want_onscreen_log=run is None,
+                                    bulk=bulk,
+                                    incremental=incremental,
+                                    progress=progress,
+                                    run=run,
+                                    dry_run=dry_run)
+            if not keep and not dry_run:
+                self.upload_file.delete()
+                self.delete() # deleting everything after import seems harh, but also keeps the DataImport admin clean
             return report_lines
 
     # load_from_csv currently expects CSV file with:
@@ -300,123 +1438,248 @@ class DataImport(models.Model):
     #     thereafter, five street names per line (may be blank)
     # arg: csv_file maybe from: open(csv_file_name, 'r')
     #      collection_type
+    #      bulk: if True, work out the changes in memory and write them all at the end (see BulkImportStore)
+    #      incremental: if True, skip rows (or the whole file) unchanged since the last import of this file (see ImportSource)
+    #      progress: called as progress(rows read, new streets, errors) as the import goes, and at the end
+    #      run: an ImportRun to store the report and counts in (see ImportLog)
+    #      dry_run: if True, work out the changes (in bulk) and report them, with a summary of the
+    #               change plan at the end (see BulkImportStore.describe_changes), but don't write them
     @staticmethod
-    def load_from_csv_file(csv_file, collection_type=None, guess_postcodes=False, want_onscreen_log=False):
+    def load_from_csv_file(csv_file, collection_type=None, guess_postcodes=False, want_onscreen_log=False, bulk=False, incremental=False, progress=None, run=None, dry_run=False):
         # nb collection_type can only be optional if it's explicitly stated inside the file (currently we don't look for this)
-        default_collection_type = collection_type
-        auto_postcode = "will" if guess_postcodes else "will not"
-        filename = os.path.split(csv_file.name)[1]
-        msg = "importing from CSV file: %s (as %s unless explicitly specified), %s guess missing postcodes" % (filename, default_collection_type, auto_postcode)
-        log_lines = DataImport._add_to_log_lines([], msg, want_onscreen_log)
+        plan = DataImport.plan_csv_file(csv_file)
+        return DataImport._load_plan(plan, csv_file, collection_type, guess_postcodes, want_onscreen_log, bulk, incremental, progress, run, dry_run)
+
+    # loads http://www.barnet.gov.uk/garden-and-kitchen-waste-collection-streets.pdf
+    # after it has been converted with "pdftohtml -xml"
+    @staticmethod
+    def load_from_pdf_xml(xml_file_name, collection_type=None, guess_postcodes=False, want_onscreen_log=False, bulk=False, incremental=False, progress=None, run=None, dry_run=False):
+        # nb collection_type can only be optional if it's explicitly stated inside the file (currently we don't look for this)
+        plan = DataImport.plan_pdf_xml(xml_file_name)
+        return DataImport._load_plan(plan, xml_file_name, collection_type, guess_postcodes, want_onscreen_log, bulk, incremental, progress, run, dry_run)
+
+    # Imports several files together, e.g. a council's refuse, recycling and
+    # garden waste files. The files are parsed into ImportPlans side by side in
+    # worker processes, then a single merge stage applies the plans, in the
+    # order given, to one BulkImportStore and writes the lot in one transaction.
+    # The merge starts on each plan as soon as its file has been parsed, while
+    # the workers get on with the rest, and the plans' rows are passed back
+    # through temporary files and read one at a time (see _plan_import_file),
+    # so memory use doesn't grow with the size of the files.
+    # The streets, collections and report come out the same as loading the
+    # files one after another.
+    # arg: files: list of (file name, collection type), each a CSV or "pdftohtml -xml" file
+    #      workers: number of processes to parse the files in (1 parses them in this one, as they're applied)
+    #      batch_size: see BulkImportStore
+    #      timer: if given, the time taken in each stage is added to it (see benchimport):
+    #             'parse' (which includes 'normalise', unless parsed in workers), 'match' and 'write'
+    #      shadow: write the changes to copies of the tables, then swap them in (see ShadowImportStore)
+    #      the rest: as load_from_csv_file; the progress counts are for all the files
+    @staticmethod
+    def load_from_files(files, guess_postcodes=False, want_onscreen_log=False, incremental=False, progress=None, run=None, workers=1, dry_run=False, batch_size=None, timer=None, shadow=False):
+        log = ImportLog(want_onscreen_log, run)
+        all_digests = []
+        for file_name, collection_type in files:
+            all_digests.append(DataImport._make_digests(file_name, file_name, collection_type, guess_postcodes, incremental))
+        # unchanged files don't need parsing
+        to_plan = [(file_name, digests and digests.content_digest) for (file_name, collection_type), digests in zip(files, all_digests)
+                if not (digests and digests.is_unchanged_file())]
+        pool = None
+        if workers > 1 and len(to_plan) > 1:
+            pool = multiprocessing.Pool(min(workers, len(to_plan)))
+            plans = pool.imap(_plan_import_file, to_plan) # in order, each as soon as it's parsed
+            if timer is not None:
+                plans = DataImport._yield_timed_rows(plans, timer) # the time spent waiting for them
+            plans = (DataImport._unspool_plan(plan) for plan in plans)
+        else:
+            plans = (DataImport.plan_file(file_name, timer, content_digest) for file_name, content_digest in to_plan)
+        try:
+            store = timed(timer, 'match', shadow and ShadowImportStore or BulkImportStore, batch_size)
+            totals = DataImport._apply_plans(DataImport._yield_imports(files, all_digests, plans), store, log, guess_postcodes, progress, dry_run, timer)
+        finally:
+            if pool is not None:
+                pool.close()
+                DataImport._discard_plans(plans)
+                pool.join()
+        if shadow and not dry_run:
+            timed(timer, 'write', store.validate_foreign_keys) # now the swap is committed
+        return log.close(*totals[:4])
+
+    # yields (plan, collection type, digests) for each of the files, taking the
+    # plans of those which need parsing from plans as they're needed
+    @staticmethod
+    def _yield_imports(files, all_digests, plans):
+        for (file_name, collection_type), digests in zip(files, all_digests):
+            if digests and digests.is_unchanged_file():
+                plan = ImportPlan(DataImport.get_file_kind(file_name), os.path.split(file_name)[1]) # just names the file in the report
+            else:
+                plan = plans.next()
+            yield plan, collection_type, digests
+
+    # the rows of a plan from _plan_import_file, read back from its temporary file
+    @staticmethod
+    def _unspool_plan(plan):
+        plan.spool_file_name = plan.rows
+        plan.rows = DataImport._yield_spooled_rows(plan.spool_file_name)
+        return plan
+
+    @staticmethod
+    def _yield_spooled_rows(spool_file_name):
+        spool_file = open(spool_file_name, 'rb')
+        try:
+            while True:
+                try:
+                    row = cPickle.load(spool_file)
+                except EOFError:
+                    break
+                yield row
+        finally:
+            spool_file.close()
+            os.remove(spool_file_name)
+
+    # removes the temporary files of plans from workers which weren't applied (as the import failed)
+    @staticmethod
+    def _discard_plans(plans):
+        try:
+            for plan in plans:
+                os.remove(plan.spool_file_name)
+        except Exception:
+            pass # e.g. a worker failed too: the import's own error is the one to report
+
+    # the merge stage of load_from_files: returns the total counts, as _apply_plan
+    @staticmethod
+    @transaction.commit_on_success
+    def _apply_plans(imports, store, log, guess_postcodes, progress, dry_run=False, timer=None):
+        totals = [0, 0, 0, 0, 0]
+        applied_digests = []
+        for plan, collection_type, digests in imports:
+            if digests and not digests.is_unchanged_file():
+                applied_digests.append(digests)
+            if not DataImport._start_import(log, plan, collection_type, guess_postcodes, digests):
+                continue
+            file_progress = None
+            if progress:
+                file_progress = lambda n_rows, n_new_streets, n_errors, totals=list(totals): progress(
+                        totals[0] + n_rows, totals[3] + n_new_streets, totals[4] + n_errors)
+            counts = DataImport._apply_plan(plan, store, log, collection_type, guess_postcodes, digests, file_progress, timer)
+            totals = [total + count for total, count in zip(totals, counts)]
+        if dry_run:
+            DataImport._log_change_plan(log, store)
+            return totals
+        timed(timer, 'write', store.write)
+        for digests in applied_digests:
+            timed(timer, 'write', digests.write)
+        return totals
+
+    # 'CSV', or 'XML' for a "pdftohtml -xml" file: by the extension, or else by looking at the start of the file
+    @staticmethod
+    def get_file_kind(file_name):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension == '.csv':
+            return 'CSV'
+        if extension == '.xml':
+            return 'XML'
+        f = open(file_name, 'rb')
+        try:
+            start = f.read(1024)
+        finally:
+            f.close()
+        if start.lstrip().startswith('<'):
+            return 'XML'
+        return 'CSV'
+
+    # The parsing half of an import: returns the ImportPlan of a CSV or "pdftohtml -xml" file
+    # timer: as load_from_files, for the time spent reading the plan's rows
+    # content_digest: as ImportPlan, if known
+    @staticmethod
+    def plan_file(file_name, timer=None, content_digest=None):
+        if DataImport.get_file_kind(file_name) == 'CSV':
+            plan = DataImport.plan_csv_file(open(file_name, 'rb'), timer)
+        else:
+            plan = DataImport.plan_pdf_xml(file_name, timer)
+        plan.content_digest = content_digest
+        if timer is not None:
+            plan.rows = DataImport._yield_timed_rows(plan.rows, timer)
+        return plan
+
+    @staticmethod
+    def plan_csv_file(csv_file, timer=None):
+        plan = ImportPlan('CSV', os.path.split(csv_file.name)[1])
+        plan.rows = DataImport._yield_csv_plan_rows(csv_file, plan, timer)
+        return plan
+
+    @staticmethod
+    def plan_pdf_xml(xml_file_name, timer=None):
+        plan = ImportPlan('XML', os.path.split(xml_file_name)[1])
+        plan.rows = DataImport._yield_pdf_plan_rows(xml_file_name, plan, timer)
+        return plan
+
+    # yields the rows, adding the time taken to get each one to the 'parse' stage of timer
+    @staticmethod
+    def _yield_timed_rows(rows, timer):
+        rows = iter(rows)
+        while True:
+            start = time.time()
+            try:
+                row = rows.next()
+            finally:
+                timer.add('parse', time.time() - start)
+            yield row
+
+    @staticmethod
+    def _yield_csv_plan_rows(csv_file, plan, timer=None):
         reader=csv.reader(csv_file, delimiter=',', quotechar='"')
-        regexp_alpha_check = re.compile('\w')
-        found_data = None
+        normalise = ImportNormaliser(timer)
         day_number_offset = 0
-        n_collections = 0
-        n_new_streets = 0
-        n_lines = 0
-        partial_postcode_check = re.compile('^[A-Z]{1,2}[0-9]{1,2}[A-Z]?$')
         for row in reader: 
-            n_lines += 1
+            plan.n_rows += 1
+            line = plan.n_rows
             if row and row[0].startswith("#"): # skip comments
                 continue
-            if found_data == 'native':
+            if plan.found_data == 'native':
                 if len(row) < 2: # skip non-conforming lines: they have no postcode or collection day
                     continue
                 street_name = row[0] # capitalisation?
-                partial_postcode= re.sub(r'^([A-Z]+[0-9]+) *[0-9][A-Z]{2}.*', r'\1', canonicalise_postcode(row[1]) )
-                if len(partial_postcode)>0 and not partial_postcode_check.match(partial_postcode):
-                    msg = "line %s: did not update street: bad partial postcode %s" % (n_lines, partial_postcode)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
+                partial_postcode, is_valid_postcode = normalise.partial_postcode(row[1])
+                if not is_valid_postcode:
+                    yield line, row, [('error', "line %s: did not update street: bad partial postcode %s" % (line, partial_postcode))]
                     continue                    
-                try:
-                    collection_type = BinCollectionType.objects.get(friendly_id=row[2])
-                except BinCollectionType.DoesNotExist:
-                    collection_type = default_collection_type # default
-                try:
-                    street, was_created, did_guess_postcode = Street.objects.get_or_create_street(street_name, partial_postcode, guess_postcodes=guess_postcodes)
-                except IntegrityError, e: # e.g., ambiguous postcode: exception may contain suggested value
-                    msg = "line %s: did not update street: %s" % (n_lines, e)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                    continue
-                if did_guess_postcode:
-                    did_guess_postcode = "(guessed postcode %s)" % street.partial_postcode
-                else:
-                    did_guess_postcode = ""
-                if was_created:
-                    msg = 'line %s: made a new street "%s" %s' % (n_lines, street, did_guess_postcode)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                    n_new_streets += 1
+                collection_type_id = len(row) > 2 and row[2] or None # else the default
+                days = []
                 if len(row)==4:
-                    this_day = BinCollection.day_of_week_string_to_number(row[3])
-                    collection_change_msg = street.add_collection(collection_type, this_day)
-                    msg = 'line %s: street %s: %s %s' % (n_lines, street, collection_change_msg, did_guess_postcode)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log) 
-                    n_collections += 1 
-            elif found_data == 'barnet':
+                    days.extend(normalise.day_numbers(row[3]))
+                yield line, row, [('street', street_name, partial_postcode, collection_type_id, days)]
+            elif plan.found_data == 'barnet':
+                steps = []
                 for day in range(len(row)): #   for this_day in 0..4 (actually monday-friday)
                     # note: here we are making these assumptions, based on current provided data:
                     #       index position is day (i.e., col 0 is on Monday)
                     #       there is NO postcode
                     # Ought to dump all failures into a log for review, and manual input, later TODO
                     this_day = day + day_number_offset
-                    this_day_name = BinCollection.number_to_day_name(this_day)
-                    street_name = ' '.join(row[day].strip().split())
+                    street_name = normalise.street_name(row[day])
                     partial_postcode = None # for now: absolutely anticipate finding one in future data
-                    if not regexp_alpha_check.match(street_name): # common: an empty entry in the row, nothing more to do
-                        continue
-                    try:
-                        street, was_created, did_guess_postcode = Street.objects.get_or_create_street(street_name, partial_postcode, guess_postcodes=guess_postcodes)
-                    except IntegrityError, e: # e.g., ambiguous postcode: exception may contain suggested value
-                        msg = "line %s: did not update street: %s" % (n_lines, e)
-                        log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
+                    if not street_name: # common: an empty entry in the row, nothing more to do
                         continue
-                    if did_guess_postcode:
-                        did_guess_postcode = "(guessed postcode %s)" % street.partial_postcode
-                    else:
-                        did_guess_postcode = ""
-                    if was_created:
-                        msg = 'line %s: made a new street "%s" %s' % (n_lines, street, did_guess_postcode)
-                        log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                        n_new_streets += 1
-                    collection_change_msg = street.add_collection(collection_type, this_day)
-                    msg = 'line %s: street %s: %s %s' % (n_lines, street, collection_change_msg, did_guess_postcode)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log) 
-                    n_collections += 1
+                    steps.append(('street', street_name, partial_postcode, None, [this_day]))
+                yield line, row, steps
             else:
                 # lazy for now: the title line is "Monday,Tuesday,...,Friday"
                 if len(row)==4 and row[0]=='street' and row[1]=='postcode' and row[2]=='type' and row[3]=='days':
-                    found_data = 'native'
+                    plan.found_data = 'native'
                 elif len(row)>=5 and row[0] == 'Monday' and row[4] == 'Friday':
-                    found_data = 'barnet'
+                    plan.found_data = 'barnet'
                     day_number_offset = 1 # because row 0 is Monday, which is 1
-        if not found_data:
-            msg = 'found no data in "%s". Check that the file has the right title line in it.' % filename
-            log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-        else:
-            msg = "lines read from import file: %s" % n_lines
-            log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-            msg = "bin collections loaded: %s" % n_collections
-            log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-            msg = "new streets created: %s" % n_new_streets
-            log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-        return log_lines
 
-    # loads http://www.barnet.gov.uk/garden-and-kitchen-waste-collection-streets.pdf
-    # after it has been converted with "pdftohtml -xml"
     @staticmethod
-    def load_from_pdf_xml(xml_file_name, collection_type=None, guess_postcodes=False, want_onscreen_log=False):
-        # nb collection_type can only be optional if it's explicitly stated inside the file (currently we don't look for this)
-        auto_postcode = "will" if guess_postcodes else "will not"
-        filename = os.path.split(xml_file_name)[1]
-        msg = "importing from XML file: %s (as %s unless explicitly specified), %s guess missing postcodes" % (filename, collection_type, auto_postcode)
-        log_lines = DataImport._add_to_log_lines([], msg, want_onscreen_log)
-        n_collections = 0
-        n_new_streets = 0
-        doc = xml.dom.minidom.parse(xml_file_name)
-        rows = DataImport._yield_rows_from_pdf(doc)
+    def _yield_pdf_plan_rows(xml_file_name, plan, timer=None):
+        plan.found_data = True # the table is found by its layout, so there's no title line to look for
+        normalise = ImportNormaliser(timer)
+        rows = iter(DataImport._get_cached_rows_from_pdf(xml_file_name, plan.content_digest))
         started = False
         for row in rows:
+            plan.n_rows += 1
+            line = plan.n_rows
             #print row
             # find header letters, e.g. A, B, C
             if len(row) == 1:
@@ -439,96 +1702,193 @@ class DataImport(models.Model):
                 started = True
             elif started:
                 # this is a useful row, store it
-                #for column in row:
-                #    print column + ",",
-                #print
-                (street_name_1, street_name_2, partial_postcode, day_of_week) = row
+                (street_name_1, street_name_2, postcode, day_of_week) = row
                 pretty_row = ', '.join(row)
-                checked_partial_postcode = Street.partial_postcode_parse(partial_postcode)
-                if not checked_partial_postcode:
-                    msg = 'Can\'t parse partial postcode "%s", ignoring row "%s"' % (partial_postcode, pretty_row)
-                    log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)                    
+                partial_postcode, is_valid_postcode = normalise.partial_postcode(postcode, partial_only=True)
+                if not is_valid_postcode:
+                    yield line, row, [('error', 'Can\'t parse partial postcode "%s", ignoring row "%s"' % (postcode, pretty_row))]
+                    continue
+                street_name = normalise.street_name(street_name_1 + " " + street_name_2)
+                if street_name is None:
+                    yield line, row, [('error', 'No street name, ignoring row "%s"' % pretty_row)]
+                    continue
+                days_of_week = normalise.day_separator_re.split(day_of_week)
+                if len(days_of_week) > 1 and not settings.BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK:
+                    yield line, row, [('error', 'Can\'t parse "%s" into a single day: ignoring row "%s"' % (day_of_week, row))]
+                    continue
+                steps = []
+                days_as_numbers = []
+                for day_name, day_of_week_as_number in zip(days_of_week, normalise.day_numbers(day_of_week, several=True)):
+                    if not day_of_week_as_number:
+                        steps.append(('error', 'Can\'t parse day of week "%s", skipping that day in row "%s"' % (day_name, row)))
+                    else:
+                        days_as_numbers.append(day_of_week_as_number)
+                if len(days_as_numbers) > 0:
+                    steps.append(('street', street_name, partial_postcode, None, days_as_numbers))
+                yield line, row, steps
+
+    # The applying half of an import: loads the file f (or file name) as planned
+    @staticmethod
+    def _load_plan(plan, f, collection_type, guess_postcodes, want_onscreen_log, bulk, incremental, progress, run, dry_run):
+        log = ImportLog(want_onscreen_log, run)
+        digests = DataImport._make_digests(plan.filename, f, collection_type, guess_postcodes, incremental)
+        if digests:
+            plan.content_digest = digests.content_digest # the rows haven't been read yet
+        if not DataImport._start_import(log, plan, collection_type, guess_postcodes, digests):
+            return log.close()
+        store = DataImport.make_store(bulk or dry_run)
+        counts = DataImport._apply_plan(plan, store, log, collection_type, guess_postcodes, digests, progress)
+        if dry_run:
+            DataImport._log_change_plan(log, store)
+            return log.close(*counts[:4])
+        store.flush()
+        if digests:
+            digests.save()
+        return log.close(*counts[:4])
+
+    @staticmethod
+    def _log_change_plan(log, store):
+        log.add("dry run: nothing has been written")
+        for msg in store.describe_changes():
+            log.add(msg)
+
+    # returns the ImportDigests of the file f (or file name), if incremental
+    @staticmethod
+    def _make_digests(filename, f, collection_type, guess_postcodes, incremental):
+        if not incremental:
+            return None
+        digests = ImportDigests(os.path.split(filename)[1], (collection_type and collection_type.id, guess_postcodes))
+        digests.digest_file(f)
+        return digests
+
+    # starts the report of an import; returns False if there's nothing to do
+    @staticmethod
+    def _start_import(log, plan, collection_type, guess_postcodes, digests):
+        auto_postcode = "will" if guess_postcodes else "will not"
+        log.add("importing from %s file: %s (as %s unless explicitly specified), %s guess missing postcodes" % (plan.kind, plan.filename, collection_type, auto_postcode))
+        if digests and digests.is_unchanged_file():
+            log.add("file unchanged since it was last imported (%s): nothing to do" % digests.source.last_imported)
+            return False
+        return True
+
+    # Makes the changes in the plan's rows with the store, and reports them to the log (but
+    # doesn't flush the store). Returns (rows read, rows skipped, collections, new streets, errors).
+    @staticmethod
+    def _apply_plan(plan, store, log, default_collection_type, guess_postcodes, digests=None, progress=None, timer=None):
+        is_csv = plan.kind == 'CSV'
+        n_skipped = 0
+        n_collections = 0
+        n_new_streets = 0
+        n_errors = 0
+        for line, row, steps in plan.rows:
+            if progress:
+                progress(line - 1, n_new_streets, n_errors)
+            if digests and digests.is_unchanged_row(row):
+                n_skipped += 1
+                continue
+            row_ok = True
+            for step in steps:
+                if step[0] == 'error':
+                    log.add(step[1], line, 'error')
+                    n_errors += 1
+                    row_ok = False
+                    continue
+                street_name, partial_postcode, collection_type_id, days = step[1:]
+                collection_type = store.get_collection_type(collection_type_id, default_collection_type)
+                try:
+                    street, was_created, did_guess_postcode = timed(timer, 'match', store.get_or_create_street, street_name, partial_postcode, guess_postcodes)
+                except IntegrityError, e: # e.g., ambiguous postcode: exception may contain suggested value
+                    if is_csv:
+                        msg = "line %s: did not update street: %s" % (line, e)
+                    else:
+                        msg = 'did not update street: %s in row "%s"' % (e, row)
+                    log.add(msg, line, 'error')
+                    n_errors += 1
+                    row_ok = False
+                    continue
+                severity = 'info'
+                if did_guess_postcode:
+                    did_guess_postcode = "(guessed postcode %s)" % street.partial_postcode
+                    severity = 'warning'
                 else:
-                    street_name = (street_name_1 + " " + street_name_2).strip()
-                    days_of_week = re.split('\W', day_of_week)
-                    if len(days_of_week) > 1 and not settings.BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK:
-                        msg = 'Can\'t parse "%s" into a single day: ignoring row "%s"' % (day_of_week, row)
-                        log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
+                    did_guess_postcode = ""
+                if was_created:
+                    if is_csv:
+                        msg = 'line %s: made a new street "%s" %s' % (line, street, did_guess_postcode)
+                    else:
+                        msg = 'made a new street %s %s' % (street, did_guess_postcode)
+                    log.add(msg, line, severity, street)
+                    n_new_streets += 1
+                for day in days:
+                    collection_change_msg = timed(timer, 'match', store.add_collection, street, collection_type, day)
+                    if is_csv:
+                        msg = 'line %s: street %s: %s %s' % (line, street, collection_change_msg, did_guess_postcode)
                     else:
-                        days_as_numbers = []
-                        for day_name in days_of_week:
-                            day_of_week_as_number = BinCollection.day_of_week_string_to_number(day_name)
-                            if not day_of_week_as_number:
-                                msg = 'Can\'t parse day of week "%s", skipping that day in row "%s"' % (day_name, row)
-                                log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                            else:
-                                days_as_numbers.append(day_of_week_as_number)
-                        if len(days_as_numbers) > 0:
-                            try:
-                                street, was_created, did_guess_postcode = Street.objects.get_or_create_street(street_name, partial_postcode, guess_postcodes=guess_postcodes)
-                            except IntegrityError, e: # e.g., ambiguous postcode: exception may contain suggested value
-                                msg = 'did not update street: %s in row "%s"' % (e, row)
-                                log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                                continue
-                            if was_created: 
-                                if did_guess_postcode:
-                                    did_guess_postcode = "(guessed postcode %s)" % street.partial_postcode
-                                else:
-                                    did_guess_postcode = ""
-                                msg = 'made a new street %s %s' % (street, did_guess_postcode)
-                                log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-                                n_new_streets += 1
-                            # used to report what was *new* in this update :-|
-                            for day_number in days_as_numbers:
-                                collection_change_msg = street.add_collection(collection_type, day_number)
-                                msg = 'street %s: %s  (from row "%s")' % (street, collection_change_msg, pretty_row)
-                                log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log) 
-                                n_collections += 1
-        msg = "bin collections loaded: %s" % n_collections
-        log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-        msg = "new streets created: %s" % n_new_streets
-        log_lines = DataImport._add_to_log_lines(log_lines, msg, want_onscreen_log)
-        return log_lines
-
-    # clumsy: either build up a list of log_lines (return the array)
-    # doing this so it plays fairly nicely in the admin interface, but also 
-    # runs helpfully from the command line
-    @staticmethod
-    def _add_to_log_lines(log_lines, msg, want_onscreen_log=False):
-        if want_onscreen_log:
-            log_lines.append(msg)
-            return log_lines
+                        # used to report what was *new* in this update :-|
+                        msg = 'street %s: %s  (from row "%s")' % (street, collection_change_msg, ', '.join(row))
+                    log.add(msg, line, severity, street)
+                    n_collections += 1
+            if digests and row_ok:
+                digests.row_done(row)
+        if not plan.found_data:
+            log.add('found no data in "%s". Check that the file has the right title line in it.' % plan.filename, severity='error')
+            n_errors += 1
         else:
-            sys.stderr.write(msg + "\n")
-            return log_lines
-            
+            if digests:
+                log.add("unchanged %s skipped: %s" % (is_csv and "lines" or "rows", n_skipped))
+            if is_csv:
+                log.add("lines read from import file: %s" % plan.n_rows)
+            log.add("bin collections loaded: %s" % n_collections)
+            log.add("new streets created: %s" % n_new_streets)
+        if progress:
+            progress(plan.n_rows, n_new_streets, n_errors)
+        return plan.n_rows, n_skipped, n_collections, n_new_streets, n_errors
+
+    @staticmethod
+    def make_store(bulk=False):
+        if bulk:
+            return BulkImportStore()
+        return ImportStore()
+
     # PDF loading, internal functions
+
+    # The text of a <text> element, including any in <b> tags inside it
     @staticmethod
-    def _get_text_from_node(nodelist):
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-            elif node.nodeType == node.ELEMENT_NODE:
-                if node.nodeName == 'b':
-                    rc = rc + DataImport._get_text_from_node(node.childNodes)
-                else:
-                    raise Exception("unfinished")
+    def _get_text_from_element(element):
+        parts = [element.text or ""]
+        for child in element:
+            if child.tag == 'b':
+                parts.append(DataImport._get_text_from_element(child))
             else:
                 raise Exception("unfinished")
-        return rc
+            parts.append(child.tail or "")
+        return unicode("".join(parts))
+
+    # Yields (top, left, text) for each <text> element in the file, reading it
+    # as a stream rather than parsing the whole document into memory: each
+    # element is thrown away once it has been read, so memory use stays flat
+    # however big the file is.
+    @staticmethod
+    def _yield_text_items(xml_file):
+        events = iterparse(xml_file, events=('start', 'end'))
+        root = None
+        for event, element in events:
+            if event == 'start':
+                if root is None:
+                    root = element
+            elif element.tag == 'text':
+                yield int(element.get('top')), int(element.get('left')), DataImport._get_text_from_element(element).strip()
+                element.clear()
+            elif element.tag == 'page':
+                root.clear() # drop the page (and the cleared <text> elements in it)
 
     # joins together items which are vertically wrapped but in the same table cell
     @staticmethod
-    def _yield_cells(nodes):
+    def _yield_cells(items):
         cell_text = ""
         last_top = None
         last_left = None
-        for node in nodes:
-            top = int(node.getAttribute('top'))
-            left = int(node.getAttribute('left'))
-            text = DataImport._get_text_from_node(node.childNodes).strip()
-
+        for top, left, text in items:
             # in vertical column exactly aligned is word wrapping in one cell
             if left == last_left:
                 # so append text to current cell
@@ -545,13 +1905,13 @@ class DataImport(models.Model):
 
     # Works out what a row in the table is, and yields each one. A row is
     # just items which are lined up vertically.
+    # xml_file is the name of the file made by "pdftohtml -xml" (or the file itself)
     @staticmethod
-    def _yield_rows_from_pdf(doc):
+    def _yield_rows_from_pdf(xml_file):
         items = []
         last_top = None
         last_left = None
-        nodes = doc.getElementsByTagName('text').__iter__()
-        for text, top, left in DataImport._yield_cells(nodes):
+        for text, top, left in DataImport._yield_cells(DataImport._yield_text_items(xml_file)):
             if top != last_top and items != []:
                 yield items
                 items = []
@@ -562,3 +1922,194 @@ class DataImport(models.Model):
             last_left = left
         if items != []:
             yield items
+
+    # change this when the way rows are read from "pdftohtml -xml" files changes, so the cached rows are read again
+    PDF_ROWS_CACHE_VERSION = 1
+
+    # The rows of a "pdftohtml -xml" file, as _yield_rows_from_pdf, but cached
+    # in settings.BINS_IMPORT_CACHE_DIR (if set) as a CSV file of the rows (in
+    # UTF-8), so working out the layout is only done once for each version of
+    # the file. The cache is keyed by the digest of the file's contents: pass
+    # it in if it's known (an incremental import works it out anyway), else
+    # the file is read through once to work it out. The rows are yielded as
+    # they're read (and written to the cache), rather than all kept at once.
+    @staticmethod
+    def _get_cached_rows_from_pdf(xml_file_name, content_digest=None):
+        if not settings.BINS_IMPORT_CACHE_DIR:
+            return DataImport._yield_rows_from_pdf(xml_file_name)
+        if content_digest is None:
+            content_digest = hashlib.sha1()
+            xml_file = open(xml_file_name, 'rb')
+            try:
+                for chunk in iter(lambda: xml_file.read(65536), ''):
+                    content_digest.update(chunk)
+            finally:
+                xml_file.close()
+            content_digest = content_digest.hexdigest()
+        key = hashlib.sha1('pdf rows %s\n%s\n' % (DataImport.PDF_ROWS_CACHE_VERSION, content_digest))
+        cache_file_name = os.path.join(settings.BINS_IMPORT_CACHE_DIR, key.hexdigest() + '.csv')
+        if os.path.exists(cache_file_name):
+            os.utime(cache_file_name, None) # still in use, so not tidied away
+            return DataImport._yield_rows_from_cache(cache_file_name)
+        return DataImport._yield_and_cache_rows_from_pdf(xml_file_name, cache_file_name)
+
+    @staticmethod
+    def _yield_rows_from_cache(cache_file_name):
+        cache_file = open(cache_file_name, 'rb')
+        try:
+            for row in csv.reader(cache_file):
+                yield [cell.decode('utf-8') for cell in row]
+        finally:
+            cache_file.close()
+
+    @staticmethod
+    def _yield_and_cache_rows_from_pdf(xml_file_name, cache_file_name):
+        if os.path.isdir(settings.BINS_IMPORT_CACHE_DIR):
+            DataImport._tidy_pdf_rows_cache()
+        else:
+            os.makedirs(settings.BINS_IMPORT_CACHE_DIR)
+        # written under another name then renamed once all the rows have been
+        # read, so a half-written cache file is never used
+        temp_file_name = '%s.%s.tmp' % (cache_file_name, os.getpid())
+        cache_file = open(temp_file_name, 'wb')
+        completed = False
+        try:
+            writer = csv.writer(cache_file)
+            for row in DataImport._yield_rows_from_pdf(xml_file_name):
+                writer.writerow([cell.encode('utf-8') for cell in row])
+                yield row
+            completed = True
+        finally:
+            cache_file.close()
+            if completed:
+                os.rename(temp_file_name, cache_file_name)
+            else:
+                os.remove(temp_file_name)
+
+    # removes cached rows which haven't been used for settings.BINS_IMPORT_CACHE_DAYS
+    # (and any temporary files left by imports which died)
+    @staticmethod
+    def _tidy_pdf_rows_cache():
+        too_old = time.time() - settings.BINS_IMPORT_CACHE_DAYS * 86400
+        for name in os.listdir(settings.BINS_IMPORT_CACHE_DIR):
+            path = os.path.join(settings.BINS_IMPORT_CACHE_DIR, name)
+            try:
+                if os.path.getmtime(path) < too_old:
+                    os.remove(path)
+            except OSError:
+                pass # e.g. another import has just removed it
+
+# Parses a file for DataImport.load_from_files, in a worker process. The
+# plan's rows are pickled to a temporary file as they're read, rather than
+# kept, and the plan is passed back with the file's name in place of its rows
+# (see DataImport._unspool_plan).
+def _plan_import_file(args):
+    file_name, content_digest = args
+    plan = DataImport.plan_file(file_name, content_digest=content_digest)
+    spool_fd, spool_file_name = tempfile.mkstemp(prefix='binalerts-plan-')
+    spool_file = os.fdopen(spool_fd, 'wb')
+    try:
+        for row in plan.rows:
+            cPickle.dump(row, spool_file, cPickle.HIGHEST_PROTOCOL)
+    except:
+        spool_file.close()
+        os.remove(spool_file_name)
+        raise
+    spool_file.close()
+    plan.rows = spool_file_name
+    return plan
+
+IMPORT_JOB_STATUS_CHOICES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+# Imports are run in the background by the runimportjobs command, rather than
+# in the admin request (where a big file can take longer than the web server
+# will wait). The admin queues an ImportJob for each DataImport, and the job's
+# counts are updated as the import goes, for the admin to show.
+class ImportJobManager(models.Manager):
+    # dry_run: only work out and report the changes (see DataImport.load_from_csv_file)
+    def enqueue(self, data_import, dry_run=False):
+        return self.create(data_import=data_import, description=unicode(data_import), dry_run=dry_run, created=datetime.datetime.now())
+
+    # Claims the oldest queued job for the holder, returns it (or None if there
+    # are none). The claim is a conditional UPDATE, so several workers can run.
+    def claim_next(self, holder):
+        while True:
+            job_ids = list(self.filter(status='queued').order_by('id').values_list('id', flat=True)[:1])
+            if not job_ids:
+                return None
+            if self.filter(id=job_ids[0], status='queued').update(status='running', holder=holder, started=datetime.datetime.now()):
+                return self.get(id=job_ids[0])
+
+class ImportJob(models.Model):
+    data_import = models.ForeignKey(DataImport, null=True, blank=True) # cleared once the import is done (and the DataImport deleted)
+    description = models.CharField(max_length=255)
+    dry_run = models.BooleanField(default=False) # if so, the DataImport is kept, for applying once the plan's been checked
+    status = models.CharField(max_length=10, choices=IMPORT_JOB_STATUS_CHOICES, default='queued')
+    holder = models.CharField(max_length=100, blank=True) # worker running it
+    created = models.DateTimeField()
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    n_rows = models.IntegerField(default=0) # rows read so far
+    n_new_streets = models.IntegerField(default=0)
+    n_errors = models.IntegerField(default=0)
+    import_run = models.ForeignKey(ImportRun, null=True, blank=True) # where the import's report is
+    report = models.TextField(blank=True) # why it failed, if it did
+
+    objects = ImportJobManager()
+
+    progress_interval = 2 # seconds between writing the counts to the database
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return 'Import job %s: %s (%s)' % (self.id, self.description, self.get_status_display())
+
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    # Runs the import (the job must have been claimed). If it fails, the
+    # DataImport is kept, so the job can be queued again.
+    def run(self):
+        data_import = self.data_import
+        if data_import is None:
+            self._finish('failed', "the file to import has been deleted")
+            return
+        self.last_progress = None
+        self.import_run = ImportRun.objects.create(description=self.description, started=datetime.datetime.now())
+        ImportJob.objects.filter(id=self.id).update(import_run=self.import_run)
+        try:
+            data_import.import_data(progress=self.update_progress, keep=True, run=self.import_run, dry_run=self.dry_run)
+        except Exception:
+            transaction.rollback_unless_managed()
+            self._finish('failed', traceback.format_exc())
+            return
+        self._finish('done', '')
+        if not self.dry_run:
+            # other jobs for the file (e.g. the dry run this one applies) are kept, not deleted along with it
+            ImportJob.objects.filter(data_import=data_import).update(data_import=None)
+            data_import.upload_file.delete()
+            data_import.delete()
+
+    # called by the import with its counts so far; only writes them every progress_interval
+    # seconds (the final counts are saved when the job finishes)
+    def update_progress(self, n_rows, n_new_streets, n_errors):
+        self.n_rows, self.n_new_streets, self.n_errors = n_rows, n_new_streets, n_errors
+        now = time.time()
+        if self.last_progress is not None and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        ImportJob.objects.filter(id=self.id).update(n_rows=n_rows, n_new_streets=n_new_streets, n_errors=n_errors)
+
+    def _finish(self, status, report):
+        self.status = status
+        self.report = report
+        self.finished = datetime.datetime.now()
+        if status == 'done' and not self.dry_run:
+            self.data_import = None
+        self.save()
@@ -61,6 +61,36 @@ BINS_ALLOW_MULTIPLE_COLLECTIONS_PER_WEEK = config.get('BINS_ALLOW_MULTIPLE_COLLE
 # But just in case there's a place with no duplicate street names, allow it to be optional
 BINS_STREETS_MUST_HAVE_POSTCODE = config.get('BINS_STREETS_MUST_HAVE_POSTCODE', True)
 
+# Alert emails are sent over one mail connection per run, in batches of this many
+# messages (the connection is reopened between batches), retrying a message on a
+# fresh connection up to BINS_ALERT_SEND_RETRIES times if sending fails.
+# Set EMAIL_HOST/EMAIL_PORT to test against a local SMTP stand-in, e.g.
+#     python -m smtpd -n -c DebuggingServer localhost:1025
+BINS_ALERT_BATCH_SIZE = config.get('BINS_ALERT_BATCH_SIZE', 100)
+BINS_ALERT_SEND_RETRIES = config.get('BINS_ALERT_SEND_RETRIES', 2)
+# An outbox message which has failed to send this many times (in separate
+# drains) is given up on, as is any alert whose recipient the server refuses.
+BINS_ALERT_MAX_ATTEMPTS = config.get('BINS_ALERT_MAX_ATTEMPTS', 5)
+EMAIL_HOST = config.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = config.get('EMAIL_PORT', 25)
+
+# Alerts are split into this many shards (by street id) so several hosts can run
+# send-alerts at once: each run leases a shard at a time for BINS_ALERT_LEASE_SECONDS
+# (renewed as it goes), so if a run dies its shard is picked up once the lease expires.
+BINS_ALERT_SHARDS = config.get('BINS_ALERT_SHARDS', 1)
+BINS_ALERT_LEASE_SECONDS = config.get('BINS_ALERT_LEASE_SECONDS', 1800)
+
+# The alertscheduler command sends each alert slot's emails (9am, 6pm) spread
+# out over this many minutes from the start of the slot, rather than all at once.
+BINS_ALERT_SLOT_WINDOW_MINUTES = config.get('BINS_ALERT_SLOT_WINDOW_MINUTES', 60)
+
+# If set, the rows read from the table in a "pdftohtml -xml" import file are
+# cached in this directory (by the digest of the file's contents), so importing
+# or previewing the same file again doesn't have to work out its layout again. Cached rows not used for BINS_IMPORT_CACHE_DAYS are removed
+# when new ones are written. Empty (the default) to not cache.
+BINS_IMPORT_CACHE_DIR = config.get('BINS_IMPORT_CACHE_DIR', '')
+BINS_IMPORT_CACHE_DAYS = config.get('BINS_IMPORT_CACHE_DAYS', 30)
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.